@@ -1,7 +1,7 @@
-from .chat import Chatter
-
-
 async def setup(bot):
+    # Imported here, so the rest of the package (like the benchmark) can be used without Red
+    from .chat import Chatter
+
     cog = Chatter(bot)
     await cog.initialize()
     r = bot.add_cog(cog)
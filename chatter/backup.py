@@ -0,0 +1,153 @@
+"""
+Streaming export and import of the statement database
+
+Backups are JSON lines, gzip compressed when the file name ends in `.gz`.
+The first line is a header, every other line is one statement.
+Nothing is held in memory beyond one chunk, so this works on databases of any size.
+"""
+
+import gzip
+import json
+import logging
+import pathlib
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import bindparam, text
+
+log = logging.getLogger("red.fox_v3.chatter.backup")
+
+FORMAT_VERSION = 1
+
+# Columns copied as they are, besides tags
+COLUMNS = (
+    "text",
+    "search_text",
+    "conversation",
+    "persona",
+    "in_response_to",
+    "search_in_response_to",
+    "created_at",
+)
+
+
+def _open(path: pathlib.Path, mode: str, compressed: bool):
+    if compressed:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def export_statements(storage, path: pathlib.Path, chunk_size=5000) -> int:
+    """Blocking, writes every statement to `path` in id order. Returns how many were written"""
+    select_statements = text(
+        f"SELECT id, {', '.join(COLUMNS)} FROM statement WHERE id > :after ORDER BY id LIMIT :limit"
+    )
+    select_tags = text(
+        "SELECT ta.statement_id, t.name FROM tag_association ta "
+        "JOIN tag t ON t.id = ta.tag_id WHERE ta.statement_id IN :ids"
+    ).bindparams(bindparam("ids", expanding=True))
+
+    written = 0
+    after = 0
+    tmp_path = path.with_name(path.name + ".tmp")
+    with _open(tmp_path, "w", compressed=path.suffix == ".gz") as f:
+        header = {"chatter_backup": FORMAT_VERSION, "language": storage.tagger.language.ISO_639_1}
+        f.write(json.dumps(header) + "\n")
+
+        while True:
+            with storage.engine.connect() as conn:
+                rows = conn.execute(select_statements, {"after": after, "limit": chunk_size})
+                rows = rows.fetchall()
+                if not rows:
+                    break
+                tags: Dict[int, List[str]] = {}
+                for statement_id, name in conn.execute(
+                    select_tags, {"ids": [row[0] for row in rows]}
+                ):
+                    tags.setdefault(statement_id, []).append(name)
+
+            for row in rows:
+                record = {
+                    column: value for column, value in zip(COLUMNS, row[1:]) if value is not None
+                }
+                if row[0] in tags:
+                    record["tags"] = tags[row[0]]
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+            written += len(rows)
+            after = rows[-1][0]
+            log.info(f"Exported {written} statements")
+
+    tmp_path.replace(path)  # A failed export doesn't leave half a backup behind
+    return written
+
+
+def _existing_pairs(storage, texts: Set[str]) -> Set[Tuple[str, str]]:
+    """(text, in_response_to) pairs already stored for these texts"""
+    query = text("SELECT text, in_response_to FROM statement WHERE text IN :texts").bindparams(
+        bindparam("texts", expanding=True)
+    )
+
+    pairs = set()
+    texts = list(texts)
+    with storage.engine.connect() as conn:
+        for start in range(0, len(texts), 500):  # Stay under sqlite's variable limit
+            pairs.update(
+                (row[0], row[1])
+                for row in conn.execute(query, {"texts": texts[start : start + 500]})
+            )
+    return pairs
+
+
+def import_statements(storage, path: pathlib.Path, batch_size=5000) -> Tuple[int, int]:
+    """
+    Blocking, adds the statements in a backup with `create_many` in batches
+
+    Statements with the same text in response to the same text as an existing one are skipped.
+    Search text is reused when the backup was made with the same spaCy model, else recalculated.
+    Returns how many statements were imported and how many were skipped.
+    """
+    Statement = storage.get_object("statement")
+    imported = 0
+    skipped = 0
+
+    with _open(path, "r", compressed=path.suffix == ".gz") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("chatter_backup") != FORMAT_VERSION:
+            raise ValueError(f"{path.name} is not a chatter backup")
+        keep_search_text = header.get("language") == storage.tagger.language.ISO_639_1
+
+        def write(batch: List[Dict]) -> int:
+            existing = _existing_pairs(storage, {record["text"] for record in batch})
+            statements = []
+            for record in batch:
+                pair = (record["text"], record.get("in_response_to"))
+                if pair in existing:  # Also catches repeats within the batch
+                    continue
+                existing.add(pair)
+                if not keep_search_text:
+                    record.pop("search_text", None)
+                    record.pop("search_in_response_to", None)
+                statements.append(Statement(**record))
+
+            if statements:
+                storage.create_many(statements)
+            return len(statements)
+
+        batch = []
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                written = write(batch)
+                imported += written
+                skipped += len(batch) - written
+                batch = []
+                log.info(f"Imported {imported} statements, skipped {skipped} duplicates")
+        if batch:
+            written = write(batch)
+            imported += written
+            skipped += len(batch) - written
+
+    log.info(f"Import of {path.name} done, {imported} statements added, {skipped} skipped")
+    return imported, skipped
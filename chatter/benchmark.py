@@ -0,0 +1,342 @@
+"""
+Reply latency benchmark, no Discord connection needed
+
+Builds statement databases of the given sizes through `MyDumbSQLStorageAdapter`,
+then replays messages through the same response generation and batched learning writes
+as the cog for every similarity algorithm, and reports latency percentiles, throughput and memory.
+
+Run from the directory containing the cog, Red itself isn't needed::
+
+    python -m chatter.benchmark --sizes 1000 10000 --messages 200
+    python -m chatter.benchmark --corpus messages.txt --algorithms jaccard levenshtein
+
+Databases are kept in `--workdir` and reused between runs of the same size and seed.
+Statements learned during a run are deleted afterwards, so every algorithm sees the same data.
+"""
+
+import argparse
+import json
+import logging
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Sequence
+
+from chatterbot import ChatBot
+from sqlalchemy import text
+
+from chatter import options
+from chatter.responses import create_chatbot, generate_response
+from chatter.stats import StageTimings
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+log = logging.getLogger("red.fox_v3.chatter.benchmark")
+
+ALGORITHMS = {
+    algo.__name__.lower().replace("similarity", "").replace("distance", ""): algo
+    for algo in options.ALGORITHMS
+}  # spacy, jaccard, levenshtein
+
+# Small Zipf-ish vocabulary, common words show up far more often like in real chat
+WORDS = (
+    "i you the a to is it and that what do not have this so be are for my of in "
+    "was just like know me can on no with your but yeah lol think good get how "
+    "about he she they we one time why people now go really want would make "
+    "game play server bot thanks night day today tomorrow work school food music "
+    "movie song love hate cool nice weird funny sorry right wrong maybe never always"
+).split()
+
+
+def _sentence(rng: random.Random) -> str:
+    length = rng.randint(2, 12)
+    words = [WORDS[min(int(rng.paretovariate(1.2)) - 1, len(WORDS) - 1)] for _ in range(length)]
+    # Mix in the long tail so not every sentence is made of the same few words
+    for i in range(0, length, 4):
+        words[i] = rng.choice(WORDS)
+    return " ".join(words).capitalize()
+
+
+def synthetic_conversations(size: int, seed: int) -> List[List[str]]:
+    """Conversations of 2 to 8 sentences adding up to `size` statements"""
+    rng = random.Random(seed)
+    conversations = []
+    remaining = size
+    while remaining > 0:
+        length = min(rng.randint(2, 8), remaining)
+        conversations.append([_sentence(rng) for _ in range(length)])
+        remaining -= length
+    return conversations
+
+
+def replay_messages(
+    count: int, seed: int, conversations: List[List[str]], corpus: Optional[pathlib.Path]
+) -> List[str]:
+    """Messages from the corpus file, or half known statements and half new sentences"""
+    rng = random.Random(seed + 1)
+    if corpus is not None:
+        with open(corpus, encoding="utf-8") as f:
+            lines = [line.strip() for line in f if line.strip()]
+        return [rng.choice(lines) for _ in range(count)]
+
+    known = [statement for conversation in conversations for statement in conversation]
+    return [rng.choice(known) if rng.random() < 0.5 else _sentence(rng) for _ in range(count)]
+
+
+def build_database(chatbot: ChatBot, conversations: List[List[str]], batch_size=5000):
+    """Writes the conversations unless the database already has them, then builds the indexes"""
+    storage = chatbot.storage
+    if storage.count():
+        log.info(f"Reusing {storage.count()} statements in {storage.database_uri}")
+    else:
+        Statement = storage.get_object("statement")
+        batch = []
+        started = time.perf_counter()
+        for number, conversation in enumerate(conversations):
+            previous = None
+            for statement_text in conversation:
+                batch.append(
+                    Statement(
+                        text=statement_text,
+                        in_response_to=previous,
+                        conversation=f"benchmark {number}",
+                    )
+                )
+                previous = statement_text
+            if len(batch) >= batch_size:
+                storage.create_many(batch)
+                batch = []
+        if batch:
+            storage.create_many(batch)
+        log.info(
+            f"Wrote {storage.count()} statements in {time.perf_counter() - started:.1f}s "
+            f"to {storage.database_uri}"
+        )
+
+    storage.build_indexes()
+
+
+def percentile(ordered: Sequence[float], fraction: float) -> float:
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _peak_rss() -> Optional[int]:
+    """Peak resident memory of this process in bytes, None where it can't be read"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KiB
+
+
+def run_replay(
+    chatbot: ChatBot, messages: List[str], learn_batch: int, trace: bool, threshold: float
+) -> Dict:
+    """
+    Answers and learns every message like `Chatter.on_message_without_command`,
+    without the response cache. Learned statements are written `learn_batch` at a time
+    like `LearningQueue`, learn times are per write
+    """
+    storage = chatbot.storage
+    Statement = storage.get_object("statement")
+    timings = StageTimings()
+    with storage.engine.connect() as conn:
+        last_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM statement")).scalar()
+
+    # Warm up, like the cog does before answering
+    generate_response(chatbot, Statement("Hello there"), similarity_threshold=threshold)
+
+    if trace:
+        tracemalloc.start()
+    generate_times = []
+    learn_times = []
+    pending = []
+    previous = None
+    started = time.perf_counter()
+    try:
+        for number, message in enumerate(messages, 1):
+            statement = Statement(message)
+            before = time.perf_counter()
+            generate_response(chatbot, statement, similarity_threshold=threshold, timings=timings)
+            generate_times.append(time.perf_counter() - before)
+
+            if learn_batch and previous is not None:
+                pending.append(
+                    Statement(
+                        message,
+                        in_response_to=previous.text,
+                        search_text=statement.search_text,
+                        search_in_response_to=previous.search_text,
+                    )
+                )
+            if pending and (len(pending) >= learn_batch or number == len(messages)):
+                before = time.perf_counter()
+                storage.create_many(pending)
+                learn_times.append(time.perf_counter() - before)
+                pending = []
+            previous = statement
+        elapsed = time.perf_counter() - started
+        traced_peak = tracemalloc.get_traced_memory()[1] if trace else None
+    finally:
+        if trace:
+            tracemalloc.stop()
+        # Leave the database as it was for the next algorithm
+        with storage.engine.connect() as conn:
+            learned = [
+                row[0]
+                for row in conn.execute(
+                    text("SELECT id FROM statement WHERE id > :last_id"), {"last_id": last_id}
+                )
+            ]
+        if learned:
+            storage.delete_statements(learned)
+
+    generate_times.sort()
+    learn_times.sort()
+    return {
+        "messages": len(messages),
+        "seconds": elapsed,
+        "throughput": len(messages) / elapsed if elapsed else float("nan"),
+        "generate": {f"p{p}": percentile(generate_times, p / 100) for p in (50, 95, 99)},
+        "learn": {f"p{p}": percentile(learn_times, p / 100) for p in (50, 95, 99)},
+        "traced_peak": traced_peak,
+        "peak_rss": _peak_rss(),
+        "stages": {
+            stage: timings.percentiles(stage) for stage in ("reply.tagging", "reply.match")
+        },
+    }
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:8.1f}"
+
+
+def _mib(size: Optional[int]) -> str:
+    return "     n/a" if size is None else f"{size / 2 ** 20:8.1f}"
+
+
+def print_report(results: List[Dict]):
+    header = (
+        f"{'algorithm':<12} {'size':>9} "
+        f"{'gen p50':>8} {'gen p95':>8} {'gen p99':>8} "
+        f"{'lrn p50':>8} {'lrn p95':>8} {'lrn p99':>8} "
+        f"{'msg/s':>8} {'traced':>8} {'rss':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        gen = result["generate"]
+        lrn = result["learn"]
+        print(
+            f"{result['algorithm']:<12} {result['size']:>9} "
+            f"{_ms(gen['p50'])} {_ms(gen['p95'])} {_ms(gen['p99'])} "
+            f"{_ms(lrn['p50'])} {_ms(lrn['p95'])} {_ms(lrn['p99'])} "
+            f"{result['throughput']:8.1f} {_mib(result['traced_peak'])} "
+            f"{_mib(result['peak_rss'])}"
+        )
+    print(
+        "\nLatencies in ms, learning per batched write, memory in MiB. "
+        "rss is the peak of the whole process so far"
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m chatter.benchmark", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000], help="Statements per database"
+    )
+    parser.add_argument(
+        "--algorithms", nargs="+", choices=list(ALGORITHMS), default=list(ALGORITHMS)
+    )
+    parser.add_argument(
+        "--model",
+        type=int,
+        default=0,
+        choices=range(len(options.MODELS)),
+        help="Same numbers as [p]chatter model",
+    )
+    parser.add_argument("--messages", type=int, default=200, help="Messages replayed per run")
+    parser.add_argument(
+        "--corpus", type=pathlib.Path, help="Text file with one message per line to replay"
+    )
+    parser.add_argument("--threshold", type=float, default=0.90)
+    parser.add_argument("--candidate-limit", type=int, default=300)
+    parser.add_argument("--candidate-mode", choices=["terms", "fts"], default="terms")
+    parser.add_argument("--vector-store", action="store_true", help="Only affects spacy")
+    parser.add_argument(
+        "--learn-batch",
+        type=int,
+        default=50,
+        help="Learned statements per write, like [p]chatter learnqueue. 0 skips learning",
+    )
+    parser.add_argument(
+        "--tracemalloc", action="store_true", help="Measure Python allocations (slower)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workdir", type=pathlib.Path, help="Where databases are kept, a temp dir otherwise"
+    )
+    parser.add_argument("--json", type=pathlib.Path, help="Also write the results here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+    logging.getLogger("chatterbot").setLevel(logging.WARNING)
+
+    temp_dir = None
+    workdir = args.workdir
+    if workdir is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="chatter_benchmark_")
+        workdir = pathlib.Path(temp_dir.name)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    model = options.MODELS[args.model]
+    results = []
+    try:
+        for size in args.sizes:
+            conversations = synthetic_conversations(size, args.seed)
+            messages = replay_messages(args.messages, args.seed, conversations, args.corpus)
+            db_path = workdir / f"benchmark_{size}_{args.seed}.sqlite3"
+
+            for name in args.algorithms:
+                chatbot = create_chatbot(
+                    db_path,
+                    model,
+                    ALGORITHMS[name],
+                    args.threshold,
+                    candidate_limit=args.candidate_limit,
+                    candidate_mode=args.candidate_mode,
+                    vector_store=args.vector_store,
+                )
+                build_database(chatbot, conversations)
+
+                log.info(f"Replaying {len(messages)} messages with {name} on {size} statements")
+                result = run_replay(
+                    chatbot, messages, args.learn_batch, args.tracemalloc, args.threshold
+                )
+                result.update(algorithm=name, size=size, model=model.ISO_639_1)
+                results.append(result)
+                chatbot.storage.engine.dispose()
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    print_report(results)
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
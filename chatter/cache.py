@@ -0,0 +1,110 @@
+import random
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+from chatterbot.conversation import Statement
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class _CacheEntry:
+    __slots__ = ("created", "generated", "responses")
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.generated = 0  # Duplicates count too, some inputs only ever get one response
+        self.responses: List[Statement] = []
+
+
+class ResponseCache:
+    """
+    LRU cache of generated responses, with entries expiring after `ttl` seconds
+
+    Keys start with the normalized input text, followed by whatever settings change the result.
+    Each key collects `pool_size` generated responses before it starts answering,
+    and then picks from them at random, so `get_random_response` variety is kept.
+    """
+
+    def __init__(self, max_entries=1000, ttl=600, pool_size=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.pool_size = pool_size
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._entries: "OrderedDict[Tuple, _CacheEntry]" = OrderedDict()
+        self._keys_by_text: Dict[str, Set[Tuple]] = defaultdict(set)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def make_key(text: str, *settings: Hashable) -> Tuple:
+        return (normalize_text(text), *settings)
+
+    def _drop(self, key: Tuple):
+        self._entries.pop(key, None)
+        keys = self._keys_by_text.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_text[key[0]]
+
+    def get(self, key: Tuple) -> Optional[Statement]:
+        """A random cached response, or None when it still needs to be generated"""
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.created > self.ttl:
+            self._drop(key)
+            entry = None
+
+        if entry is None or entry.generated < self.pool_size:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return random.choice(entry.responses)
+
+    def peek(self, key: Tuple) -> Optional[Statement]:
+        """Any cached response even if the pool isn't full yet, without counting a hit or miss"""
+        entry = self._entries.get(key)
+        if entry is None or not entry.responses:
+            return None
+        return random.choice(entry.responses)
+
+    def add(self, key: Tuple, response: Statement):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _CacheEntry()
+            self._keys_by_text[key[0]].add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+        else:
+            self._entries.move_to_end(key)
+
+        entry.generated += 1
+        if len(entry.responses) < self.pool_size and all(
+            r.text != response.text for r in entry.responses
+        ):
+            entry.responses.append(response)
+
+    def invalidate_text(self, text: str):
+        """Forget every entry for this input text, used when learning a new response to it"""
+        keys = self._keys_by_text.pop(normalize_text(text), ())
+        for key in keys:
+            self._entries.pop(key, None)
+        self.invalidations += len(keys)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_text.clear()
@@ -1,31 +1,43 @@
 import asyncio
+import json
 import logging
-import os
 import pathlib
-from collections import defaultdict
-from datetime import datetime, timedelta, timezone
+import re
+import shutil
+import time
+from collections import OrderedDict, defaultdict
 from functools import partial
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Optional
 
 import discord
 from chatterbot import ChatBot
-from chatterbot.comparisons import (
-    JaccardSimilarity,
-    LevenshteinDistance,
-    SpacySimilarity,
-)
-from chatterbot.response_selection import get_random_response
+from chatterbot.comparisons import SpacySimilarity
+from chatterbot.conversation import Statement
 from chatterbot.trainers import (
     ChatterBotCorpusTrainer,
-    ListTrainer,
     UbuntuCorpusTrainer,
 )
 from redbot.core import Config, checks, commands
 from redbot.core.commands import Cog
 from redbot.core.data_manager import cog_data_path
+from redbot.core.utils.chat_formatting import box, humanize_number, pagify
 from redbot.core.utils.predicates import MessagePredicate
 
-from chatter.trainers import MovieTrainer, TwitterCorpusTrainer, UbuntuCorpusTrainer2
+from chatter import backup, maintenance, responses, spacy_models
+from chatter.cache import ResponseCache
+from chatter.context import ContextEntry, ConversationContext
+from chatter.inference import InferencePool, InferencePoolFull
+from chatter.learning import LearningQueue
+from chatter.options import ALGORITHMS, ENG_SM, MODELS
+from chatter.stats import StageTimings
+from chatter.trainers import (
+    MovieTrainer,
+    StreamingListTrainer,
+    TwitterCorpusTrainer,
+    UbuntuCorpusTrainer2,
+    default_tagging_workers,
+)
 
 chatterbot_log = logging.getLogger("red.fox_v3.chatterbot")
 log = logging.getLogger("red.fox_v3.chatter")
@@ -38,37 +50,17 @@ def my_local_get_prefix(prefixes, content):
     return None
 
 
-class ENG_TRF:
-    ISO_639_1 = "en_core_web_trf"
-    ISO_639 = "eng"
-    ENGLISH_NAME = "English"
-
-
-class ENG_LG:
-    ISO_639_1 = "en_core_web_lg"
-    ISO_639 = "eng"
-    ENGLISH_NAME = "English"
-
-
-class ENG_MD:
-    ISO_639_1 = "en_core_web_md"
-    ISO_639 = "eng"
-    ENGLISH_NAME = "English"
-
-
-class ENG_SM:
-    ISO_639_1 = "en_core_web_sm"
-    ISO_639 = "eng"
-    ENGLISH_NAME = "English"
-
-
 class Chatter(Cog):
     """
     This cog trains a chatbot that will talk like members of your Guild
     """
 
-    models = [ENG_SM, ENG_MD, ENG_LG, ENG_TRF]
-    algos = [SpacySimilarity, JaccardSimilarity, LevenshteinDistance]
+    models = MODELS
+    algos = ALGORITHMS
+
+    harvest_concurrency = 3  # Channels fetched at once during channel training
+    maintenance_interval = 60 * 60  # Seconds
+    max_open_shards = 8  # Guild databases kept open at once when sharding
 
     def __init__(self, bot):
         super().__init__()
@@ -79,6 +71,18 @@ class Chatter(Cog):
             "model_number": 0,
             "algo_number": 0,
             "threshold": 0.90,
+            "candidate_limit": 300,
+            "candidate_mode": "terms",
+            "vector_store": False,
+            "learn_batch_size": 50,
+            "learn_flush_seconds": 30,
+            "inference_workers": 2,
+            "inference_queue": 10,
+            "tagging_workers": None,  # One per core
+            "max_statements": 0,
+            "sharding": False,
+            "shared_corpus": True,
+            "slow_reply_seconds": 5.0,
         }
         self.default_guild = {
             "whitelist": None,
@@ -86,6 +90,8 @@ class Chatter(Cog):
             "convo_delta": 15,
             "chatchannel": None,
             "reply": True,
+            "watermarks": {},
+            "shard": None,
         }
         path: pathlib.Path = cog_data_path(self)
         self.data_path = path / "database.sqlite3"
@@ -96,7 +102,16 @@ class Chatter(Cog):
         self.tagger_language = ENG_SM
         self.similarity_algo = SpacySimilarity
         self.similarity_threshold = 0.90
-        self.chatbot = None
+        self.candidate_limit = 300
+        self.candidate_mode = "terms"
+        self.vector_store = False
+        self.sharding = False
+        self.shared_corpus = True
+        self.chatbot = None  # The global corpus, or the only database when not sharding
+        self._shards: "OrderedDict[str, ChatBot]" = OrderedDict()
+        self._chatbot_lock = asyncio.Lock()
+        self._load_task: Optional[asyncio.Task] = None
+        self._maintenance_task: Optional[asyncio.Task] = None
         # self.chatbot.set_trainer(ListTrainer)
 
         # self.trainer = ListTrainer(self.chatbot)
@@ -109,12 +124,33 @@ class Chatter(Cog):
         self._guild_cache = defaultdict(dict)
         self._global_cache = {}
 
-        self._last_message_per_channel: Dict[Optional[discord.Message]] = defaultdict(lambda: None)
+        self.context = ConversationContext()
+
+        self.response_cache = ResponseCache()
+        self.learning_queue = LearningQueue(on_flush=self._learned)
+        self.inference_pool = InferencePool()
+        self.usage_tracker = maintenance.UsageTracker()
+        self.timings = StageTimings()
+        self.slow_reply_seconds = 5.0
+        self.tagging_workers = None
 
     async def red_delete_data_for_user(self, **kwargs):
         """Nothing to delete"""
         return
 
+    def cog_unload(self):
+        if self._load_task is not None:
+            self._load_task.cancel()
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        self.inference_pool.shutdown()
+        # Don't lose what was learned but not written yet
+        asyncio.create_task(self._save_pending())
+
+    async def _save_pending(self):
+        await self.learning_queue.close()
+        await self.loop.run_in_executor(None, self.usage_tracker.flush)
+
     async def initialize(self):
         all_config = dict(self.config.defaults["GLOBAL"])
         all_config.update(await self.config.all())
@@ -125,79 +161,300 @@ class Chatter(Cog):
         self.tagger_language = self.models[model_number]
         self.similarity_algo = self.algos[algo_number]
         self.similarity_threshold = threshold
-        self.chatbot = self._create_chatbot()
-
-    def _create_chatbot(self):
-        return ChatBot(
-            "ChatterBot",
-            # storage_adapter="chatterbot.storage.SQLStorageAdapter",
-            storage_adapter="chatter.storage_adapters.MyDumbSQLStorageAdapter",
-            database_uri="sqlite:///" + str(self.data_path),
-            statement_comparison_function=self.similarity_algo,
-            response_selection_method=get_random_response,
-            logic_adapters=["chatterbot.logic.BestMatch"],
-            maximum_similarity_threshold=self.similarity_threshold,
-            tagger_language=self.tagger_language,
+        self.candidate_limit = all_config["candidate_limit"]
+        self.candidate_mode = all_config["candidate_mode"]
+        self.vector_store = all_config["vector_store"]
+        self.sharding = all_config["sharding"]
+        self.shared_corpus = all_config["shared_corpus"]
+        self.slow_reply_seconds = all_config["slow_reply_seconds"]
+        self.tagging_workers = all_config["tagging_workers"]
+        self.learning_queue.max_size = all_config["learn_batch_size"]
+        self.learning_queue.max_delay = all_config["learn_flush_seconds"]
+        self.inference_pool.resize(all_config["inference_workers"], all_config["inference_queue"])
+
+        # Loading a spaCy model takes a while, don't hold up the bot starting
+        self._load_task = asyncio.create_task(self._swap_chatbot())
+        self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+
+    async def _maintenance_loop(self):
+        """Saves usage, enforces the statement cap and slowly gives free space back to the disk"""
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                await self.loop.run_in_executor(None, self.usage_tracker.flush)
+                max_statements = await self.config.max_statements()
+            except Exception:
+                log.exception("Chatter maintenance failed")
+                continue
+
+            # Closed shards are skipped, they'll get their turn while they're in use
+            for chatbot in self._open_chatbots():
+                storage = chatbot.storage
+                try:
+                    if max_statements:
+                        await self.loop.run_in_executor(
+                            None, maintenance.enforce_max_rows, storage, max_statements
+                        )
+
+                    if await self.loop.run_in_executor(
+                        None, maintenance.uses_incremental_vacuum, storage
+                    ):
+                        await self._vacuum(storage)
+                except Exception:
+                    log.exception(f"Chatter maintenance failed for {storage.database_uri}")
+
+    async def _vacuum(self, storage):
+        """Incremental vacuum in small steps, so replies aren't blocked for long"""
+        while await self.loop.run_in_executor(None, maintenance.incremental_vacuum, storage):
+            await asyncio.sleep(1)
+
+    def _response_cache_key(self, text: str, shard: Optional[str]):
+        return self.response_cache.make_key(
+            text,
+            shard,
+            self.tagger_language.ISO_639_1,
+            self.similarity_algo.__name__,
+            self.similarity_threshold,
+        )
+
+    def _create_chatbot(self, data_path: pathlib.Path = None, tagger_language=None):
+        """Blocking, builds and warms up a new chatbot. See `_swap_chatbot` and `_get_chatbot`"""
+        return responses.create_chatbot(
+            data_path or self.data_path,
+            tagger_language or self.tagger_language,
+            self.similarity_algo,
+            self.similarity_threshold,
+            candidate_limit=self.candidate_limit,
+            candidate_mode=self.candidate_mode,
+            vector_store=self.vector_store,
+            timings=self.timings,
             logger=chatterbot_log,
         )
 
-    async def _get_conversation(self, ctx, in_channels: List[discord.TextChannel]):
+    async def _swap_chatbot(self, tagger_language=None):
         """
-        Compiles all conversation in the Guild this bot can get it's hands on
-        Currently takes a stupid long time
-        Returns a list of text
+        Builds a chatbot with the current settings in the background, then swaps it in
+
+        The old chatbot keeps answering until the new one is ready.
+        `tagger_language` only becomes the current language once the new chatbot loaded
         """
-        out = [[]]
-        after = datetime.today() - timedelta(days=(await self.config.guild(ctx.guild).days()))
-        convo_delta = timedelta(minutes=(await self.config.guild(ctx.guild).convo_delta()))
+        tagger_language = tagger_language or self.tagger_language
+        async with self._chatbot_lock:
+            try:
+                chatbot = await self.loop.run_in_executor(
+                    None, self._create_chatbot, None, tagger_language
+                )
+            except Exception:
+                log.exception("Failed to create the chatbot, keeping the previous one")
+                return False
 
-        def predicate(msg: discord.Message):
-            return msg.clean_content
+            self.chatbot = chatbot
+            self.tagger_language = tagger_language
+            self.response_cache.clear()  # Database or settings changed, cached responses may be wrong
 
-        def new_conversation(msg, sent, out_in, delta):
-            # Should always be positive numbers
-            return msg.created_at - sent >= delta
+            # Guild databases reopen with the new settings the next time they're needed
+            shards = list(self._shards.values())
+            self._shards.clear()
 
-        for channel in in_channels:
-            # if in_channel:
-            #     channel = in_channel
-            await ctx.maybe_send_embed("Gathering {}".format(channel.mention))
-            user = None
-            i = 0
-            send_time = after - timedelta(days=100)  # Makes the first message a new message
+        for shard in shards:
+            await self._close_chatbot(shard)
+        spacy_models.release(keep=[self.tagger_language.ISO_639_1])  # After a model switch
 
-            try:
-                async for message in channel.history(
-                    limit=None, after=after, oldest_first=True
-                ).filter(
-                    predicate=predicate
-                ):  # type: discord.Message
-                    # if message.author.bot:  # Skip bot messages
-                    #     continue
-                    if new_conversation(message, send_time, out[i], convo_delta):
-                        out.append([])
-                        i += 1
-                        user = None
-
-                    send_time = (
-                        message.created_at
-                    )  # + timedelta(seconds=1)  # Can't remember why I added 1 second
-
-                    if user == message.author:
-                        out[i][-1] += "\n" + message.clean_content
-                    else:
-                        user = message.author
-                        out[i].append(message.clean_content)
+        # Backfilling can take a while on big databases, indexes are only used once it's done
+        asyncio.create_task(self._build_indexes(chatbot))
+        return True
 
-            except discord.Forbidden:
-                pass
-            except discord.HTTPException:
-                pass
+    def _open_chatbots(self) -> List[ChatBot]:
+        chatbots = list(self._shards.values())
+        if self.chatbot is not None:
+            chatbots.insert(0, self.chatbot)
+        return chatbots
+
+    def _shard_path(self, shard: str) -> pathlib.Path:
+        return cog_data_path(self) / "guilds" / f"{shard}.sqlite3"
+
+    async def _shard_name(self, guild: discord.Guild) -> Optional[str]:
+        """The database this guild uses, None for the global one"""
+        if not self.sharding:
+            return None
+        return await self.config.guild(guild).shard() or str(guild.id)
+
+    async def _get_chatbot(self, guild: Optional[discord.Guild]) -> Optional[ChatBot]:
+        """
+        The chatbot for this guild's database when sharding, otherwise the global one
+
+        The most recently used guild databases are kept open, see `max_open_shards`.
+        None while the global chatbot is still loading
+        """
+        if guild is None or self.chatbot is None:
+            return self.chatbot
+        shard = await self._shard_name(guild)
+        if shard is None:
+            return self.chatbot
+
+        chatbot = self._shards.get(shard)
+        if chatbot is None:
+            async with self._chatbot_lock:
+                chatbot = self._shards.get(shard)  # Opened while we waited
+                if chatbot is None:
+                    path = self._shard_path(shard)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    try:
+                        chatbot = await self.loop.run_in_executor(None, self._create_chatbot, path)
+                    except Exception:
+                        log.exception(f"Failed to open the database for {shard}")
+                        return None
+                    self._shards[shard] = chatbot
+                    asyncio.create_task(self._build_indexes(chatbot))
+
+                    while len(self._shards) > self.max_open_shards:
+                        _, evicted = self._shards.popitem(last=False)
+                        asyncio.create_task(self._close_chatbot(evicted))
+
+        if shard in self._shards:  # Could have been closed by a settings change meanwhile
+            self._shards.move_to_end(shard)
+        return chatbot
+
+    async def _build_indexes(self, chatbot: ChatBot):
+        """Backfills the chatbot's indexes in the background, logging anything that fails"""
+        try:
+            await self.loop.run_in_executor(None, chatbot.storage.build_indexes)
+        except Exception:
+            log.exception(f"Failed to build the indexes of {chatbot.storage.database_uri}")
 
-            # if in_channel:
-            #     break
+    def _learned(self, statements: List[Statement]):
+        """
+        Cached responses to these statements' input text are missing the new ones
 
-        return out
+        Only once they're written, a cache refill before that would stay stale until it expires
+        """
+        for statement in statements:
+            self.response_cache.invalidate_text(statement.in_response_to)
+
+    async def _get_ready_chatbot(
+        self, ctx: commands.Context, guild: Optional[discord.Guild] = None
+    ) -> Optional[ChatBot]:
+        """`_get_chatbot`, telling the user to try again when it isn't loaded"""
+        chatbot = await self._get_chatbot(guild)
+        if chatbot is None:
+            await ctx.maybe_send_embed("The chatbot is still loading, try again in a bit")
+        return chatbot
+
+    async def _close_chatbot(self, chatbot: ChatBot):
+        """Writes anything pending for a chatbot that's no longer used and closes its database"""
+        await self.learning_queue.flush()
+        await self.loop.run_in_executor(None, self.usage_tracker.flush)
+        chatbot.storage.engine.dispose()
+
+    def _generate_response(self, chatbot: ChatBot, statement, timings: Dict[str, float] = None):
+        """
+        Blocking, asks the guild's chatbot first, then the shared global corpus
+        if that wasn't confident enough. See `responses.generate_response`
+        """
+        return responses.generate_response(
+            chatbot,
+            statement,
+            corpus=self.chatbot if self.shared_corpus else None,
+            similarity_threshold=self.similarity_threshold,
+            timings=self.timings,
+            stages=timings,
+        )
+
+    async def _harvest_channel(
+        self,
+        channel: discord.TextChannel,
+        after: datetime,
+        convo_delta: timedelta,
+        out: asyncio.Queue,
+        watermarks: Dict[int, int],
+    ):
+        """
+        Streams the conversations of one channel into `out` as soon as each one ends
+
+        Records the newest message id seen in `watermarks`
+        """
+        conversation = []
+        user = None
+        send_time = None
+
+        try:
+            async for message in channel.history(
+                limit=None, after=after, oldest_first=True
+            ):  # type: discord.Message
+                watermarks[channel.id] = message.id
+                if not message.clean_content:
+                    continue
+                # if message.author.bot:  # Skip bot messages
+                #     continue
+
+                # Should always be positive numbers
+                if send_time is not None and message.created_at - send_time >= convo_delta:
+                    with self.timings.time("harvest.queue_wait"):  # Waiting on training
+                        await out.put(conversation)
+                    conversation = []
+                    user = None
+
+                send_time = message.created_at
+
+                if user == message.author:
+                    conversation[-1] += "\n" + message.clean_content
+                else:
+                    user = message.author
+                    conversation.append(message.clean_content)
+
+        except discord.Forbidden:
+            pass
+        except discord.HTTPException:
+            pass
+
+        if conversation:
+            await out.put(conversation)
+
+    async def _harvest_conversations(
+        self, ctx, in_channels: List[discord.TextChannel], out: asyncio.Queue
+    ) -> Dict[int, int]:
+        """
+        Streams all conversation in the given channels into `out`, several channels at a time
+
+        Only messages newer than the last training run (the channel watermark) are fetched.
+        `None` is put on the queue once every channel is done.
+        Returns the newest message id seen per channel, save it once training succeeded
+        """
+        guild_config = self.config.guild(ctx.guild)
+        after = datetime.today() - timedelta(days=(await guild_config.days()))
+        convo_delta = timedelta(minutes=(await guild_config.convo_delta()))
+        saved_watermarks = await guild_config.watermarks()
+
+        semaphore = asyncio.Semaphore(self.harvest_concurrency)
+        watermarks = {}
+
+        async def harvest(channel: discord.TextChannel):
+            channel_after = after
+            watermark = saved_watermarks.get(str(channel.id))
+            if watermark is not None and discord.utils.snowflake_time(
+                watermark
+            ) > channel_after.astimezone(timezone.utc):
+                channel_after = discord.Object(id=watermark)
+
+            async with semaphore:
+                await ctx.maybe_send_embed("Gathering {}".format(channel.mention))
+                with self.timings.time("harvest.channel"):
+                    await self._harvest_channel(
+                        channel, channel_after, convo_delta, out, watermarks
+                    )
+
+        cancelled = False
+        try:
+            await asyncio.gather(*(harvest(channel) for channel in in_channels))
+        except asyncio.CancelledError:
+            # Training stopped, nothing reads `out` anymore so there may never be room for None
+            cancelled = True
+            raise
+        finally:
+            if not cancelled:
+                await out.put(None)
+
+        return watermarks
 
     def _train_twitter(self, *args, **kwargs):
         trainer = TwitterCorpusTrainer(self.chatbot)
@@ -213,7 +470,9 @@ class Chatter(Cog):
         return True
 
     async def _train_movies(self):
-        trainer = MovieTrainer(self.chatbot, cog_data_path(self))
+        trainer = MovieTrainer(
+            self.chatbot, cog_data_path(self), workers=self.tagging_workers, timings=self.timings
+        )
         return await trainer.asynctrain()
 
     async def _train_ubuntu2(self, intensity):
@@ -233,7 +492,9 @@ class Chatter(Cog):
             train_kwarg["train_196"] = True
             train_kwarg["train_301"] = True
 
-        trainer = UbuntuCorpusTrainer2(self.chatbot, cog_data_path(self))
+        trainer = UbuntuCorpusTrainer2(
+            self.chatbot, cog_data_path(self), workers=self.tagging_workers, timings=self.timings
+        )
         return await trainer.asynctrain(**train_kwarg)
 
     def _train_english(self):
@@ -244,15 +505,6 @@ class Chatter(Cog):
         #     return False
         return True
 
-    def _train(self, data):
-        trainer = ListTrainer(self.chatbot)
-        total = len(data)
-        for c, convo in enumerate(data, 1):
-            log.info(f"{c} / {total}")
-            if len(convo) > 1:  # TODO: Toggleable skipping short conversations
-                trainer.train(convo)
-        return True
-
     @commands.group(invoke_without_command=False)
     async def chatter(self, ctx: commands.Context):
         """
@@ -340,19 +592,28 @@ class Chatter(Cog):
             return
         async with ctx.typing():
             await self.config.clear_all()
+            await self.learning_queue.close()  # Written now rather than racing the delete
+            chatbots = list(self._shards.values())
+            if self.chatbot is not None:
+                chatbots.append(self.chatbot)
             self.chatbot = None
+            self._shards.clear()
+            for chatbot in chatbots:
+                await self._close_chatbot(chatbot)
             await asyncio.sleep(
                 10
             )  # Pause to allow pending commands to complete before deleting sql data
-            if os.path.isfile(self.data_path):
-                try:
-                    os.remove(self.data_path)
-                except PermissionError:
-                    await ctx.maybe_send_embed(
-                        "Failed to clear training database. Please wait a bit and try again"
-                    )
+            try:
+                # Also the WAL files and vector stores, a new database starts its ids over
+                for file in self.data_path.parent.glob(f"{self.data_path.name}*"):
+                    file.unlink()
+            except PermissionError:
+                await ctx.maybe_send_embed(
+                    "Failed to clear training database. Please wait a bit and try again"
+                )
+            shutil.rmtree(cog_data_path(self) / "guilds", ignore_errors=True)
 
-            self._create_chatbot()
+            await self._swap_chatbot()
 
         await ctx.tick()
 
@@ -386,10 +647,487 @@ class Chatter(Cog):
         await self.config.algo_number.set(algo_number)
 
         async with ctx.typing():
-            self.chatbot = self._create_chatbot()
+            await self._swap_chatbot()
+
+            await ctx.tick()
+
+    @commands.is_owner()
+    @chatter.command(name="candidates")
+    async def chatter_candidates(
+        self, ctx: commands.Context, limit: int, mode: Optional[str] = None
+    ):
+        """
+        Set how many candidate statements are compared when looking for a response
+
+        Candidates are the statements sharing the most words with the message.
+        Lower is faster, higher may find better matches. Default is 300
+        Use 0 to compare every possible match like before (slow on large databases)
+
+        Optionally choose how candidates are found:
+        terms: Statements sharing the most words (default)
+        fts: sqlite's full-text search ranked by BM25
+        """
+        if limit < 0 or (mode is not None and mode.lower() not in ("terms", "fts")):
+            await ctx.send_help()
+            return
+
+        self.candidate_limit = limit
+        await self.config.candidate_limit.set(limit)
+        if mode is not None:
+            self.candidate_mode = mode.lower()
+            await self.config.candidate_mode.set(self.candidate_mode)
+
+        async with ctx.typing():
+            await self._swap_chatbot()
 
             await ctx.tick()
 
+    @commands.is_owner()
+    @chatter.command(name="vectors")
+    async def chatter_vectors(self, ctx: commands.Context, toggle: Optional[bool] = None):
+        """
+        Toggle precomputed statement vectors for the Spacy algorithm
+
+        Each statement's vector is calculated once and saved next to the database,
+        so finding a response no longer parses every candidate with spaCy.
+        Uses extra disk space, and the first start has to calculate all existing statements.
+        """
+        if toggle is None:
+            toggle = not self.vector_store
+        self.vector_store = toggle
+        await self.config.vector_store.set(toggle)
+
+        async with ctx.typing():
+            await self._swap_chatbot()
+
+        if toggle:
+            await ctx.maybe_send_embed(
+                "Statement vectors are now enabled. They only apply to the Spacy algorithm"
+            )
+        else:
+            await ctx.maybe_send_embed("Statement vectors are now disabled")
+
+    @commands.is_owner()
+    @chatter.command(name="sharding")
+    async def chatter_sharding(self, ctx: commands.Context, toggle: Optional[bool] = None):
+        """
+        Toggle giving each guild its own training database
+
+        Guilds learn and train into their own database, so a large guild
+        doesn't slow down the others and can be cleaned up on its own.
+        The existing database becomes the global corpus, see `[p]chatter sharedcorpus`
+        """
+        if toggle is None:
+            toggle = not self.sharding
+        await self.config.sharding.set(toggle)
+
+        async with self._chatbot_lock:
+            self.sharding = toggle
+            self.response_cache.clear()
+            shards = list(self._shards.values())
+            self._shards.clear()
+        for shard in shards:
+            await self._close_chatbot(shard)
+
+        if toggle:
+            await ctx.maybe_send_embed("Each guild now has its own training database")
+        else:
+            await ctx.maybe_send_embed("All guilds now share the global training database")
+
+    @commands.is_owner()
+    @chatter.command(name="sharedcorpus")
+    async def chatter_sharedcorpus(self, ctx: commands.Context, toggle: Optional[bool] = None):
+        """
+        Toggle searching the global corpus when a guild's database has no confident response
+
+        Only applies when sharding. This is on by default.
+        """
+        if toggle is None:
+            toggle = not self.shared_corpus
+        self.shared_corpus = toggle
+        await self.config.shared_corpus.set(toggle)
+        self.response_cache.clear()
+
+        if toggle:
+            await ctx.maybe_send_embed("The global corpus will be searched as a fallback")
+        else:
+            await ctx.maybe_send_embed("Guilds will only use their own database")
+
+    @commands.is_owner()
+    @chatter.command(name="shardgroup")
+    async def chatter_shardgroup(self, ctx: commands.Context, name: Optional[str] = None):
+        """
+        Share one training database between guilds using the same group name
+
+        Pass with no name to give this guild its own database again.
+        Statements already learned stay in the previous database.
+        """
+        if name is not None and not re.fullmatch(r"[A-Za-z0-9_-]{1,32}", name):
+            await ctx.maybe_send_embed(
+                "Group names can only use letters, numbers, `_` and `-`, up to 32 characters"
+            )
+            return
+
+        await self.config.guild(ctx.guild).shard.set(name)
+        if name is None:
+            await ctx.maybe_send_embed("This guild now uses its own database")
+        else:
+            await ctx.maybe_send_embed(f"This guild now uses the `{name}` database")
+
+    @commands.is_owner()
+    @chatter.command(name="clearguild")
+    async def chatter_clearguild(self, ctx: commands.Context, confirm: bool = False):
+        """
+        Erase the training data of this guild's database
+
+        Only available when sharding. Other guilds in the same shard group lose it as well.
+
+        Use `[p]chatter clearguild True` to confirm.
+        """
+        shard = await self._shard_name(ctx.guild)
+        if shard is None:
+            await ctx.maybe_send_embed(
+                "This guild uses the global database, see `[p]chatter sharding`"
+            )
+            return
+
+        if not confirm:
+            await ctx.maybe_send_embed(
+                "Warning, this command will erase all training data of this guild's database\n"
+                "If you want to proceed, run the command again as `[p]chatter clearguild True`"
+            )
+            return
+
+        async with ctx.typing():
+            async with self._chatbot_lock:
+                chatbot = self._shards.pop(shard, None)
+            if chatbot is not None:
+                await self._close_chatbot(chatbot)
+            self.response_cache.clear()
+            await asyncio.sleep(5)  # Let replies using it finish
+
+            path = self._shard_path(shard)
+            try:
+                for file in path.parent.glob(f"{path.name}*"):
+                    file.unlink()
+            except PermissionError:
+                await ctx.maybe_send_embed(
+                    "Failed to clear the guild's database. Please wait a bit and try again"
+                )
+                return
+
+        await ctx.tick()
+
+    @commands.is_owner()
+    @chatter.command(name="learnqueue")
+    async def chatter_learnqueue(
+        self, ctx: commands.Context, batch_size: int = None, flush_seconds: float = None
+    ):
+        """
+        Show the learning queue, or change when it gets written to the database
+
+        Learned responses are saved together once `batch_size` are waiting
+        or after `flush_seconds`, whichever comes first.
+        Defaults are 50 and 30 seconds.
+        """
+        if batch_size is not None:
+            if batch_size < 1 or (flush_seconds is not None and flush_seconds <= 0):
+                await ctx.send_help()
+                return
+            self.learning_queue.max_size = batch_size
+            await self.config.learn_batch_size.set(batch_size)
+        if flush_seconds is not None:
+            self.learning_queue.max_delay = flush_seconds
+            await self.config.learn_flush_seconds.set(flush_seconds)
+
+        await ctx.maybe_send_embed(
+            f"Waiting to be saved: {self.learning_queue.depth}\n"
+            f"Saved since load: {self.learning_queue.total_learned} "
+            f"in {self.learning_queue.total_flushes} batches\n"
+            f"Batch size: {self.learning_queue.max_size}, "
+            f"flushed every {self.learning_queue.max_delay} seconds"
+        )
+
+    @commands.is_owner()
+    @chatter.command(name="trainworkers")
+    async def chatter_trainworkers(self, ctx: commands.Context, workers: int = None):
+        """
+        Show or set how many processes tag statements for the kaggle trainers
+
+        Each one loads its own copy of the spaCy model, so more workers train faster
+        but use that much more memory. Default is one per core, leaving one free.
+        Use 0 to go back to the default
+        """
+        if workers is not None:
+            if workers < 0:
+                await ctx.send_help()
+                return
+            self.tagging_workers = workers or None
+            await self.config.tagging_workers.set(self.tagging_workers)
+
+        count = self.tagging_workers or default_tagging_workers()
+        await ctx.maybe_send_embed(
+            f"Kaggle training tags with {count} process{'es' if count != 1 else ''}"
+            + (" (one per core)" if self.tagging_workers is None else "")
+        )
+
+    @commands.is_owner()
+    @chatter.command(name="cache")
+    async def chatter_cache(self, ctx: commands.Context, clear: bool = False):
+        """
+        Show how often responses come from the response cache
+
+        Use `[p]chatter cache True` to empty the cache
+        """
+        cache = self.response_cache
+        if clear:
+            cache.clear()
+
+        await ctx.maybe_send_embed(
+            f"Cached inputs: {len(cache)} / {cache.max_entries}\n"
+            f"Hits: {cache.hits}, Misses: {cache.misses} ({cache.hit_rate:.1%} hit rate)\n"
+            f"Invalidated by learning: {cache.invalidations}\n"
+            f"Responses kept per input: {cache.pool_size}, expire after {cache.ttl} seconds"
+        )
+
+    @commands.is_owner()
+    @chatter.command(name="inference")
+    async def chatter_inference(
+        self, ctx: commands.Context, workers: int = None, queue_size: int = None
+    ):
+        """
+        Show response generation metrics for this guild, or resize the worker pool
+
+        `workers` responses are generated at once, and `queue_size` more may wait.
+        Messages beyond that get a cached response or are skipped.
+        Defaults are 2 workers and a queue of 10.
+        """
+        if workers is not None:
+            if queue_size is None:
+                queue_size = self.inference_pool.queue_size
+            if workers < 1 or queue_size < 0:
+                await ctx.send_help()
+                return
+            self.inference_pool.resize(workers, queue_size)
+            await self.config.inference_workers.set(workers)
+            await self.config.inference_queue.set(queue_size)
+
+        pool = self.inference_pool
+        await ctx.maybe_send_embed(
+            f"Workers: {pool.workers}, Queue size: {pool.queue_size}, "
+            f"In flight: {pool.in_flight}\n\n"
+            f"**{ctx.guild.name}**\n{pool.metrics[ctx.guild.id].summary()}"
+        )
+
+    @commands.is_owner()
+    @chatter.command(name="stats")
+    async def chatter_stats(self, ctx: commands.Context, clear: bool = False):
+        """
+        Show how long each stage of replying, gathering and training takes
+
+        Times are in milliseconds, over the last 500 of each stage.
+        `similarity` is a single comparison, a reply usually makes many.
+        Use `[p]chatter stats True` to start over
+        """
+        if clear:
+            self.timings.clear()
+            await ctx.tick()
+            return
+
+        summary = self.timings.summary()
+        if "\n" not in summary:
+            await ctx.maybe_send_embed("Nothing recorded yet")
+            return
+
+        footer = (
+            f"\n\nSlow replies (over {self.slow_reply_seconds}s) are logged with their stages"
+            if self.slow_reply_seconds
+            else ""
+        )
+        for page in pagify(summary + footer):
+            await ctx.send(box(page))
+
+    @commands.is_owner()
+    @chatter.command(name="slowreply")
+    async def chatter_slowreply(self, ctx: commands.Context, seconds: float):
+        """
+        Log the stage timings of replies slower than this many seconds
+
+        Use 0 to turn it off. Default is 5 seconds
+        """
+        if seconds < 0:
+            await ctx.send_help()
+            return
+
+        self.slow_reply_seconds = seconds
+        await self.config.slow_reply_seconds.set(seconds)
+        await ctx.tick()
+
+    @commands.is_owner()
+    @chatter.command(name="dbstats")
+    async def chatter_dbstats(self, ctx: commands.Context):
+        """
+        Show database table sizes, indexes and how the common lookups are planned
+        """
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+        async with ctx.typing():
+            stats = await self.loop.run_in_executor(None, chatbot.storage.get_db_stats)
+
+        out = (
+            f"Database: {humanize_number(stats['file_size'])} bytes "
+            f"({humanize_number(stats['free_size'])} free)\n\n"
+            "Rows:\n"
+        )
+        out += "\n".join(
+            f"  {name}: {humanize_number(rows)}" for name, rows in stats["tables"].items()
+        )
+        if stats["sizes"]:
+            out += "\n\nSize on disk:\n"
+            out += "\n".join(
+                f"  {name}: {humanize_number(size)} bytes" for name, size in stats["sizes"].items()
+            )
+        out += "\n\nIndexes:\n"
+        out += "\n".join(f"  {name} on {table}" for name, table in stats["indexes"].items())
+        out += "\n\nQuery plans:\n"
+        for name, plan in stats["plans"].items():
+            out += f"  {name}:\n" + "\n".join(f"    {step}" for step in plan) + "\n"
+
+        for page in pagify(out):
+            await ctx.send(box(page))
+
+    @commands.is_owner()
+    @chatter.group(name="maintenance")
+    async def chatter_maintenance(self, ctx: commands.Context):
+        """
+        Commands for cleaning up the training database
+
+        When sharding, these apply to this guild's database
+        """
+        pass
+
+    @chatter_maintenance.command(name="dedupe")
+    async def chatter_maintenance_dedupe(self, ctx: commands.Context):
+        """Remove duplicate statements that have the same text in response to the same text"""
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+        async with ctx.typing():
+            deleted = await self.loop.run_in_executor(
+                None, maintenance.deduplicate, chatbot.storage
+            )
+        self.response_cache.clear()
+        await ctx.maybe_send_embed(f"Removed {humanize_number(deleted)} duplicate statements")
+
+    @chatter_maintenance.command(name="prune")
+    async def chatter_maintenance_prune(
+        self, ctx: commands.Context, criteria: str, value: str, confirm: bool = False
+    ):
+        """
+        Remove statements by age, conversation or usage
+
+        `age <days>`: Learned more than this many days ago
+        `conversation <name>`: From this conversation, such as `training`
+        `unused <days>`: Not given as a response in this many days
+
+        Add `True` at the end to confirm
+        """
+        criteria = criteria.lower()
+        kwargs = {}
+        if criteria in ("age", "unused"):
+            try:
+                days = int(value)
+            except ValueError:
+                await ctx.send_help()
+                return
+            # Local time, like the `created_at` ChatterBot stores
+            cutoff = datetime.now() - timedelta(days=days)
+            kwargs["older_than" if criteria == "age" else "unused_since"] = cutoff
+        elif criteria == "conversation":
+            kwargs["conversation"] = value
+        else:
+            await ctx.send_help()
+            return
+
+        if not confirm:
+            await ctx.maybe_send_embed(
+                "Warning, this will permanently delete training data\n"
+                f"If you want to proceed, run `{ctx.prefix}chatter maintenance prune "
+                f"{criteria} {value} True`"
+            )
+            return
+
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+        async with ctx.typing():
+            deleted = await self.loop.run_in_executor(
+                None, partial(maintenance.prune, chatbot.storage, **kwargs)
+            )
+        self.response_cache.clear()
+        await ctx.maybe_send_embed(f"Removed {humanize_number(deleted)} statements")
+
+    @chatter_maintenance.command(name="cap")
+    async def chatter_maintenance_cap(self, ctx: commands.Context, max_statements: int):
+        """
+        Keep at most this many statements, evicting the least recently used ones
+
+        Checked every hour. Use 0 to remove the limit
+        When sharding, the limit applies to each guild's database separately
+        """
+        if max_statements < 0:
+            await ctx.send_help()
+            return
+
+        await self.config.max_statements.set(max_statements)
+        if not max_statements:
+            await ctx.maybe_send_embed("Statement limit removed")
+            return
+
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+        async with ctx.typing():
+            deleted = await self.loop.run_in_executor(
+                None, maintenance.enforce_max_rows, chatbot.storage, max_statements
+            )
+        self.response_cache.clear()
+        await ctx.maybe_send_embed(
+            f"Statements are now capped at {humanize_number(max_statements)}, "
+            f"{humanize_number(deleted)} were evicted"
+        )
+
+    @chatter_maintenance.command(name="vacuum")
+    async def chatter_maintenance_vacuum(self, ctx: commands.Context, confirm: bool = False):
+        """
+        Give free space in the database back to the disk
+
+        The first run needs one full VACUUM, which blocks responses until it's done.
+        After that it happens in small steps in the background every hour.
+        """
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+        storage = chatbot.storage
+        if not await self.loop.run_in_executor(None, maintenance.uses_incremental_vacuum, storage):
+            if not confirm:
+                await ctx.maybe_send_embed(
+                    "The database needs one full VACUUM first, "
+                    "which can take a long time on large databases and blocks responses.\n"
+                    f"If you want to proceed, run `{ctx.prefix}chatter maintenance vacuum True`"
+                )
+                return
+            async with ctx.typing():
+                await self.loop.run_in_executor(
+                    None, maintenance.enable_incremental_vacuum, storage
+                )
+        else:
+            async with ctx.typing():
+                await self._vacuum(storage)
+
+        await ctx.tick()
+
     @commands.is_owner()
     @chatter.command(name="model")
     async def chatter_model(self, ctx: commands.Context, model_number: int):
@@ -418,10 +1156,15 @@ class Chatter(Cog):
             if not pred.result:
                 return
 
-        self.tagger_language = self.models[model_number]
-        await self.config.model_number.set(model_number)
+        tagger_language = self.models[model_number]
         async with ctx.typing():
-            self.chatbot = self._create_chatbot()
+            if not await self._swap_chatbot(tagger_language):
+                await ctx.maybe_send_embed(
+                    f"Failed to load {tagger_language.ISO_639_1}, see console for logs. "
+                    f"The previous model is still in use."
+                )
+                return
+            await self.config.model_number.set(model_number)
 
             await ctx.maybe_send_embed(
                 f"Model has been switched to {self.tagger_language.ISO_639_1}"
@@ -464,6 +1207,17 @@ class Chatter(Cog):
         await self.config.guild(ctx.guild).days.set(days)
         await ctx.tick()
 
+    @commands.is_owner()
+    @chatter_trainset.command(name="forget")
+    async def forget(self, ctx: commands.Context):
+        """
+        Forget which messages were already trained on
+
+        The next channel training will go through the full history set by `[p]chatter trainset age`
+        """
+        await self.config.guild(ctx.guild).watermarks.clear()
+        await ctx.tick()
+
     @commands.is_owner()
     @chatter.command(name="kaggle")
     async def chatter_kaggle(self, ctx: commands.Context):
@@ -475,30 +1229,84 @@ class Chatter(Cog):
 
     @commands.is_owner()
     @chatter.command(name="backup")
-    async def backup(self, ctx, backupname):
+    async def backup(self, ctx, backupname, compress: bool = True):
         """
-        Backup your training data to a json for later use
+        Backup your training data to a file for later use
+
+        The backup is written a chunk at a time, compressed unless `compress` is False.
+        Use `[p]chatter restore` to load it, on this bot or another one
         """
 
         await ctx.maybe_send_embed("Backing up data, this may take a while")
 
         path: pathlib.Path = cog_data_path(self)
+        file = path / f"{pathlib.Path(backupname).name}.jsonl{'.gz' if compress else ''}"
 
-        trainer = ListTrainer(self.chatbot)
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+        try:
+            async with ctx.typing():
+                count = await self.loop.run_in_executor(
+                    None, backup.export_statements, chatbot.storage, file
+                )
+        except Exception:
+            log.exception("Failed to back up the training data")
+            await ctx.maybe_send_embed("Error occurred :(")
+            return
 
-        future = await self.loop.run_in_executor(
-            None, trainer.export_for_training, str(path / f"{backupname}.json")
+        await ctx.maybe_send_embed(
+            f"Backup successful! {humanize_number(count)} statements saved to {file}"
         )
 
-        if future:
-            await ctx.maybe_send_embed(f"Backup successful! Look in {path} for your backup")
+    @commands.is_owner()
+    @chatter.command(name="restore")
+    async def restore(self, ctx, backupname):
+        """
+        Load the training data of a backup made with `[p]chatter backup`
+
+        The backup must be in the cog's data folder.
+        Statements that are already in the database are skipped.
+        """
+        path: pathlib.Path = cog_data_path(self)
+        name = pathlib.Path(backupname).name
+        for file in (path / name, path / f"{name}.jsonl.gz", path / f"{name}.jsonl"):
+            if file.is_file():
+                break
         else:
+            await ctx.maybe_send_embed(f"Couldn't find a backup named {name} in {path}")
+            return
+
+        await ctx.maybe_send_embed("Restoring data, this may take a while")
+
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+        try:
+            async with ctx.typing():
+                imported, skipped = await self.loop.run_in_executor(
+                    None, backup.import_statements, chatbot.storage, file
+                )
+        except Exception:
+            log.exception(f"Failed to restore {file}")
             await ctx.maybe_send_embed("Error occurred :(")
+            return
+
+        self.response_cache.clear()
+        await ctx.maybe_send_embed(
+            f"Restore successful! {humanize_number(imported)} statements added, "
+            f"{humanize_number(skipped)} already known"
+        )
 
     @commands.is_owner()
     @chatter.group(name="train")
     async def chatter_train(self, ctx: commands.Context):
-        """Commands for training the bot"""
+        """
+        Commands for training the bot
+
+        When sharding, channel training goes into this guild's database
+        and everything else into the global corpus
+        """
         pass
 
     @chatter_train.group(name="kaggle")
@@ -525,6 +1333,9 @@ class Chatter(Cog):
             )
             return
 
+        if await self._get_ready_chatbot(ctx) is None:
+            return
+
         async with ctx.typing():
             future = await self._train_ubuntu2(intensity)
 
@@ -551,6 +1362,9 @@ class Chatter(Cog):
             )
             return
 
+        if await self._get_ready_chatbot(ctx) is None:
+            return
+
         async with ctx.typing():
             future = await self._train_movies()
 
@@ -572,6 +1386,9 @@ class Chatter(Cog):
             )
             return
 
+        if await self._get_ready_chatbot(ctx) is None:
+            return
+
         async with ctx.typing():
             future = await self.loop.run_in_executor(None, self._train_ubuntu)
 
@@ -585,6 +1402,9 @@ class Chatter(Cog):
         """
         Trains the bot in english
         """
+        if await self._get_ready_chatbot(ctx) is None:
+            return
+
         async with ctx.typing():
             future = await self.loop.run_in_executor(None, self._train_english)
 
@@ -626,31 +1446,47 @@ class Chatter(Cog):
             "If you experience issues, clear your trained data and train again on a smaller scope."
         )
 
-        async with ctx.typing():
-            conversation = await self._get_conversation(ctx, channels)
-
-        if not conversation:
-            await ctx.maybe_send_embed("Failed to gather training data")
-            return
-
         await ctx.maybe_send_embed(
-            "Gather successful! Training begins now\n"
+            "Training begins now, while conversations are gathered\n"
             "(**This will take a long time, be patient. See console for progress**)"
         )
+        chatbot = await self._get_ready_chatbot(ctx, ctx.guild)
+        if chatbot is None:
+            return
+
         embed = discord.Embed(title="Loading")
         embed.set_image(url="http://www.loop.universaleverything.com/animations/1295.gif")
         temp_message = await ctx.send(embed=embed)
-        future = await self.loop.run_in_executor(None, self._train, conversation)
 
+        conversations = asyncio.Queue(maxsize=100)
+        harvest = asyncio.create_task(self._harvest_conversations(ctx, channels, conversations))
         try:
-            await temp_message.delete()
-        except discord.Forbidden:
-            pass
+            async with ctx.typing():
+                trained = await StreamingListTrainer(chatbot, timings=self.timings).asynctrain(
+                    conversations
+                )
+                watermarks = await harvest
+        except Exception:
+            harvest.cancel()
+            log.exception("Failed to train on channel history")
+            trained = None
+        finally:
+            try:
+                await temp_message.delete()
+            except discord.Forbidden:
+                pass
 
-        if future:
-            await ctx.maybe_send_embed("Training successful!")
-        else:
+        if trained is None:
             await ctx.maybe_send_embed("Error occurred :(")
+            return
+
+        async with self.config.guild(ctx.guild).watermarks() as saved_watermarks:
+            saved_watermarks.update({str(c_id): m_id for c_id, m_id in watermarks.items()})
+
+        if trained:
+            await ctx.maybe_send_embed(f"Training successful! Trained on {trained} conversations")
+        else:
+            await ctx.maybe_send_embed("No new conversations to train on")
 
     @Cog.listener()
     async def on_message_without_command(self, message: discord.Message):
@@ -667,12 +1503,19 @@ class Chatter(Cog):
         if len(message.content) < 2 or message.author.bot:
             return
 
+        started = time.perf_counter()
+        stages: Dict[str, float] = {}  # This reply's share of `self.timings`
+
         guild: discord.Guild = getattr(message, "guild", None)
 
-        if guild is None or await self.bot.cog_disabled_in_guild(self, guild):
+        if guild is None:
             return
+        with self.timings.time("reply.config", stages):
+            if await self.bot.cog_disabled_in_guild(self, guild):
+                return
 
-        ctx: commands.Context = await self.bot.get_context(message)
+        with self.timings.time("reply.get_context", stages):
+            ctx: commands.Context = await self.bot.get_context(message)
 
         if ctx.prefix is not None:  # Probably unnecessary, we're in on_message_without_command
             return
@@ -682,7 +1525,8 @@ class Chatter(Cog):
         channel: discord.TextChannel = message.channel
 
         if not self._guild_cache[guild.id]:
-            self._guild_cache[guild.id] = await self.config.guild(guild).all()
+            with self.timings.time("reply.config", stages):
+                self._guild_cache[guild.id] = await self.config.guild(guild).all()
 
         is_reply = False  # this is only useful with in_response_to
         if (
@@ -707,40 +1551,70 @@ class Chatter(Cog):
 
         text = message.clean_content
 
+        with self.timings.time("reply.open_db", stages):
+            chatbot = await self._get_chatbot(guild)
+        if chatbot is None:  # Still loading
+            return
+
         async with ctx.typing():
+            previous: Optional[ContextEntry] = None
             if is_reply:
-                in_response_to = message.reference.resolved.content
-            elif self._last_message_per_channel[ctx.channel.id] is not None:
-                last_m: discord.Message = self._last_message_per_channel[ctx.channel.id]
-                minutes = self._guild_cache[ctx.guild.id]["convo_delta"]
-                if (discord.utils.utcnow() - last_m.created_at).seconds > minutes * 60:
-                    in_response_to = None
-                else:
-                    in_response_to = last_m.content
+                resolved: discord.Message = message.reference.resolved
+                previous = self.context.get(channel.id, resolved.id) or ContextEntry(
+                    resolved.id, resolved.created_at, resolved.content, from_bot=True
+                )
             else:
-                in_response_to = None
+                last_reply = self.context.last_reply(channel.id)
+                minutes = self._guild_cache[ctx.guild.id]["convo_delta"]
+                if (
+                    last_reply is not None
+                    and (discord.utils.utcnow() - last_reply.created_at).total_seconds()
+                    <= minutes * 60
+                ):
+                    previous = last_reply
+            in_response_to = previous.text if previous is not None else None
 
             # Always use generate reponse
             # Chatterbot tries to learn based on the result it comes up with, which is dumb
-            log.debug("Generating response")
-            Statement = self.chatbot.storage.get_object("statement")
-            future = await self.loop.run_in_executor(
-                None, self.chatbot.generate_response, Statement(text)
-            )
+            Statement = chatbot.storage.get_object("statement")
+            statement = Statement(text)
+            with self.timings.time("reply.cache", stages):
+                cache_key = self._response_cache_key(text, await self._shard_name(guild))
+                future = self.response_cache.get(cache_key)
+            if future is None:
+                log.debug("Generating response")
+                try:
+                    with self.timings.time("reply.generate", stages):
+                        future = await self.inference_pool.run(
+                            guild.id, self._generate_response, chatbot, statement, stages
+                        )
+                except InferencePoolFull:
+                    # Too busy, answer from the cache if we can, otherwise don't reply
+                    # but still learn from the message and keep the context going
+                    future = self.response_cache.peek(cache_key)
+                    if future is None:
+                        log.debug("Inference pool is full, not replying to message")
+                else:
+                    if future and str(future):
+                        self.response_cache.add(cache_key, future)
+
+            if future is not None:
+                self.usage_tracker.record(future)
 
             if not self._global_cache:
-                self._global_cache = await self.config.all()
+                with self.timings.time("reply.config", stages):
+                    self._global_cache = await self.config.all()
 
             if in_response_to is not None and self._global_cache["learning"] and not channel.nsfw:
                 log.debug("learning response")
-                await self.loop.run_in_executor(
-                    None,
-                    partial(
-                        self.chatbot.learn_response,
-                        Statement(text),
-                        previous_statement=in_response_to,
-                    ),
+                # Search text from generating this response and the previous one is reused,
+                # anything missing (like after a cache hit) gets tagged when it's written
+                learned = Statement(
+                    text,
+                    search_text=statement.search_text,
+                    search_in_response_to=previous.search_text,
                 )
+                self.learning_queue.put(chatbot, learned, in_response_to)
 
             replying = None
             if (
@@ -749,13 +1623,40 @@ class Chatter(Cog):
                 if message != ctx.channel.last_message:
                     replying = message
 
-            if future and str(future):
-                self._last_message_per_channel[ctx.channel.id] = await channel.send(
-                    str(future), reference=replying
+            self.context.add(
+                channel.id,
+                ContextEntry(message.id, message.created_at, text, statement.search_text),
+            )
+
+            if future is None:
+                pass  # Inference pool was full
+            elif future and str(future):
+                with self.timings.time("reply.send", stages):
+                    sent = await channel.send(str(future), reference=replying)
+                self.context.add(
+                    channel.id,
+                    ContextEntry(
+                        sent.id, sent.created_at, str(future), future.search_text, from_bot=True
+                    ),
                 )
             else:
                 await ctx.send(":thinking:")
 
+        total = time.perf_counter() - started
+        self.timings.record("reply.total", total)
+        if self.slow_reply_seconds and total >= self.slow_reply_seconds:
+            record = {
+                "guild_id": guild.id,
+                "channel_id": channel.id,
+                "message_id": message.id,
+                "total_ms": round(total * 1000, 1),
+                "stages_ms": {stage: round(value * 1000, 1) for stage, value in stages.items()},
+                "inference_in_flight": self.inference_pool.in_flight,
+            }
+            log.warning(
+                f"Slow chatter reply: {json.dumps(record)}", extra={"chatter_reply": record}
+            )
+
     async def check_for_kaggle(self):
         """Check whether Kaggle is installed and configured properly"""
         # TODO: This
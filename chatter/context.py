@@ -0,0 +1,62 @@
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Optional
+
+
+class ContextEntry:
+    __slots__ = ("message_id", "created_at", "text", "search_text", "from_bot")
+
+    def __init__(
+        self,
+        message_id: int,
+        created_at: datetime,
+        text: str,
+        search_text: str = "",
+        from_bot: bool = False,
+    ):
+        self.message_id = message_id
+        self.created_at = created_at
+        self.text = text
+        self.search_text = search_text  # Empty when it wasn't tagged
+        self.from_bot = from_bot
+
+
+class ConversationContext:
+    """
+    The last `size` messages of each channel the bot talks in, along with their search text
+
+    Each message is tagged once, when its response is generated, and that search text
+    is reused as `search_in_response_to` when learning the next message.
+    Only the `max_channels` most recently active channels are kept.
+    """
+
+    def __init__(self, size=10, max_channels=1000):
+        self.size = size
+        self.max_channels = max_channels
+        self._channels: "OrderedDict[int, Deque[ContextEntry]]" = OrderedDict()
+
+    def add(self, channel_id: int, entry: ContextEntry):
+        entries = self._channels.get(channel_id)
+        if entries is None:
+            entries = self._channels[channel_id] = deque(maxlen=self.size)
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+        entries.append(entry)
+
+    def get(self, channel_id: int, message_id: int) -> Optional[ContextEntry]:
+        for entry in reversed(self._channels.get(channel_id, ())):
+            if entry.message_id == message_id:
+                return entry
+        return None
+
+    def last_reply(self, channel_id: int) -> Optional[ContextEntry]:
+        """The bot's most recent message in the channel"""
+        for entry in reversed(self._channels.get(channel_id, ())):
+            if entry.from_bot:
+                return entry
+        return None
+
+    def clear(self):
+        self._channels.clear()
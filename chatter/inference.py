@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict
+
+log = logging.getLogger("red.fox_v3.chatter.inference")
+
+
+class InferencePoolFull(Exception):
+    pass
+
+
+class GuildInferenceMetrics:
+    """Recent queue wait and execution times for one guild, in seconds"""
+
+    def __init__(self, samples=200):
+        self.completed = 0
+        self.shed = 0
+        self.waits: Deque[float] = deque(maxlen=samples)
+        self.runs: Deque[float] = deque(maxlen=samples)
+
+    def record(self, wait: float, run: float):
+        self.completed += 1
+        self.waits.append(wait)
+        self.runs.append(run)
+
+    @staticmethod
+    def _summary(samples) -> str:
+        if not samples:
+            return "n/a"
+        ordered = sorted(samples)
+        average = sum(ordered) / len(ordered)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return f"avg {average * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms"
+
+    def summary(self) -> str:
+        return (
+            f"Completed: {self.completed}, Shed: {self.shed}\n"
+            f"Queue wait: {self._summary(self.waits)}\n"
+            f"Execution: {self._summary(self.runs)}"
+        )
+
+
+class InferencePool:
+    """
+    Dedicated threads for `generate_response`, so chat bursts don't starve the default executor
+
+    At most `workers` calls run at once and `queue_size` more may wait.
+    Anything past that raises `InferencePoolFull` right away instead of queueing.
+    """
+
+    def __init__(self, workers=2, queue_size=10):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.metrics: Dict[int, GuildInferenceMetrics] = defaultdict(GuildInferenceMetrics)
+
+        self._executor = self._make_executor()
+        self._in_flight = 0  # Waiting plus running
+
+    def _make_executor(self):
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chatter_inference")
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def is_full(self) -> bool:
+        return self._in_flight >= self.workers + self.queue_size
+
+    def resize(self, workers: int, queue_size: int):
+        old_executor = self._executor
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = self._make_executor()
+        old_executor.shutdown(wait=False)  # Running calls still finish
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    async def run(self, guild_id: int, func: Callable, *args):
+        metrics = self.metrics[guild_id]
+        if self.is_full:
+            metrics.shed += 1
+            raise InferencePoolFull()
+
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            result = func(*args)
+            return started, time.perf_counter(), result
+
+        self._in_flight += 1
+        try:
+            started, finished, result = await asyncio.get_event_loop().run_in_executor(
+                self._executor, timed
+            )
+        finally:
+            self._in_flight -= 1
+
+        metrics.record(started - submitted, finished - started)
+        return result
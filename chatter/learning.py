@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from chatterbot.conversation import Statement
+
+log = logging.getLogger("red.fox_v3.chatter.learning")
+
+
+class LearningQueue:
+    """
+    Write-behind buffer for `ChatBot.learn_response`
+
+    Learned statements are held in memory and written with one `create_many` per
+    storage adapter, once `max_size` statements are waiting or `max_delay` seconds passed.
+    One transaction per flush instead of one per message keeps writes from
+    fighting with `generate_response` reads.
+    `on_flush` is called with the statements once they are written.
+    """
+
+    def __init__(
+        self,
+        max_size=50,
+        max_delay=30.0,
+        on_flush: Optional[Callable[[List[Statement]], None]] = None,
+    ):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        self.loop = asyncio.get_event_loop()
+
+        self.total_learned = 0
+        self.total_flushes = 0
+
+        self._pending: Dict[int, Tuple[object, List[Statement]]] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(statements) for _, statements in self._pending.values())
+
+    def put(self, chatbot, statement: Statement, previous_statement: str):
+        """Same as `learn_response`, but written on the next flush"""
+        statement.in_response_to = previous_statement
+        log.debug(f'Queueing "{statement.text}" as a response to "{previous_statement}"')
+
+        storage = chatbot.storage
+        self._pending.setdefault(id(storage), (storage, []))[1].append(statement)
+
+        if self.depth >= self.max_size:
+            self.loop.create_task(self.flush())
+        elif self._timer is None or self._timer.done():
+            self._timer = self.loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            pending = self._pending
+            self._pending = {}
+
+            for storage, statements in pending.values():
+                try:
+                    await self.loop.run_in_executor(None, storage.create_many, statements)
+                except Exception:
+                    log.exception(f"Failed to save {len(statements)} learned statements")
+                else:
+                    self.total_learned += len(statements)
+                    if self.on_flush is not None:
+                        self.on_flush(statements)
+            if pending:
+                self.total_flushes += 1
+
+    async def close(self):
+        """Write everything still waiting, used on unload"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
@@ -0,0 +1,174 @@
+"""
+Database upkeep for the chatter statement store
+
+Everything here is blocking and works in small chunks, so run it in an executor.
+Replies keep working in between chunks thanks to WAL mode.
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text
+
+log = logging.getLogger("red.fox_v3.chatter.maintenance")
+
+# Same format SQLAlchemy stores `created_at` in, so they compare as text.
+# ChatterBot stores `created_at` in local time, so usage times are local too
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class UsageTracker:
+    """Remembers which statements were used as responses, saved in batches per database"""
+
+    def __init__(self):
+        self._usage: Dict[int, Tuple[object, Dict[int, Tuple[str, int]]]] = {}
+
+    def record(self, statement):
+        """`statement.storage` must be set to the storage adapter it came from"""
+        if statement.id is None or statement.storage is None:  # Default responses
+            return
+        storage = statement.storage
+        usage = self._usage.setdefault(id(storage), (storage, {}))[1]
+        _, hits = usage.get(statement.id, (None, 0))
+        usage[statement.id] = (datetime.now().strftime(TIME_FORMAT), hits + 1)
+
+    def flush(self):
+        pending = self._usage
+        self._usage = {}
+        for storage, usage in pending.values():
+            storage.record_usage(usage)
+
+
+def _delete_in_chunks(storage, query: str, params: Dict, chunk_size: int, limit=None) -> int:
+    """
+    Deletes the statements `query` selects, `query` must select ids greater than `:after`
+    ordered by id and take `:limit`
+    """
+    deleted = 0
+    after = 0
+    while limit is None or deleted < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - deleted)
+        with storage.engine.connect() as conn:
+            ids: List[int] = [
+                row[0]
+                for row in conn.execute(text(query), {**params, "after": after, "limit": size})
+            ]
+        if not ids:
+            break
+        storage.delete_statements(ids)
+        deleted += len(ids)
+        after = ids[-1]
+    return deleted
+
+
+def deduplicate(storage, chunk_size=1000) -> int:
+    """Removes repeated (text, in_response_to) pairs, keeping the oldest one"""
+    deleted = _delete_in_chunks(
+        storage,
+        "SELECT s.id FROM statement s WHERE s.id > :after AND EXISTS ("
+        "SELECT 1 FROM statement o WHERE o.text = s.text "
+        "AND o.in_response_to IS s.in_response_to AND o.id < s.id"
+        ") ORDER BY s.id LIMIT :limit",
+        {},
+        chunk_size,
+    )
+    log.info(f"Removed {deleted} duplicate statements")
+    return deleted
+
+
+def prune(
+    storage,
+    older_than: datetime = None,
+    conversation: str = None,
+    unused_since: datetime = None,
+    chunk_size=1000,
+) -> int:
+    """
+    Removes statements matching every given condition
+
+    `unused_since` removes statements that weren't given as a response since then,
+    and that are older than that themselves
+    """
+    conditions = []
+    params = {}
+    if older_than is not None:
+        conditions.append("s.created_at < :older_than")
+        params["older_than"] = older_than.strftime(TIME_FORMAT)
+    if conversation is not None:
+        conditions.append("s.conversation = :conversation")
+        params["conversation"] = conversation
+    if unused_since is not None:
+        conditions.append(
+            "s.created_at < :unused_since AND NOT EXISTS ("
+            "SELECT 1 FROM statement_usage u WHERE u.statement_id = s.id "
+            "AND u.last_matched >= :unused_since)"
+        )
+        params["unused_since"] = unused_since.strftime(TIME_FORMAT)
+
+    if not conditions:
+        raise ValueError("Refusing to prune without any condition")
+
+    deleted = _delete_in_chunks(
+        storage,
+        f"SELECT s.id FROM statement s WHERE s.id > :after AND {' AND '.join(conditions)} "
+        f"ORDER BY s.id LIMIT :limit",
+        params,
+        chunk_size,
+    )
+    log.info(f"Pruned {deleted} statements")
+    return deleted
+
+
+def enforce_max_rows(storage, max_rows: int, chunk_size=1000) -> int:
+    """Evicts the least recently matched statements until at most `max_rows` remain"""
+    last_used = "COALESCE(u.last_matched, s.created_at)"
+    with storage.engine.connect() as conn:
+        excess = conn.execute(text("SELECT COUNT(*) FROM statement")).scalar() - max_rows
+        if excess <= 0:
+            return 0
+        # Sorted once, the last statement to evict. Everything used before it goes
+        cutoff = conn.execute(
+            text(
+                f"SELECT {last_used}, s.id FROM statement s "
+                "LEFT JOIN statement_usage u ON u.statement_id = s.id "
+                f"ORDER BY {last_used}, s.id LIMIT 1 OFFSET :offset"
+            ),
+            {"offset": excess - 1},
+        ).fetchone()
+    if cutoff is None:
+        return 0
+
+    deleted = _delete_in_chunks(
+        storage,
+        "SELECT s.id FROM statement s LEFT JOIN statement_usage u ON u.statement_id = s.id "
+        f"WHERE s.id > :after AND ({last_used} < :cutoff_used "
+        f"OR ({last_used} = :cutoff_used AND s.id <= :cutoff_id)) "
+        "ORDER BY s.id LIMIT :limit",
+        {"cutoff_used": cutoff[0], "cutoff_id": cutoff[1]},
+        chunk_size,
+        limit=excess,
+    )
+
+    if deleted:
+        log.info(f"Evicted {deleted} least recently matched statements")
+    return deleted
+
+
+def uses_incremental_vacuum(storage) -> bool:
+    with storage.engine.connect() as conn:
+        return conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2  # INCREMENTAL
+
+
+def enable_incremental_vacuum(storage):
+    """One full VACUUM is needed to switch modes. Slow and locks the database while it runs"""
+    with storage.engine.connect() as conn:
+        conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+
+
+def incremental_vacuum(storage, pages=256) -> int:
+    """Gives up to `pages` free pages back to the filesystem, returns how many are left"""
+    with storage.engine.connect() as conn:
+        conn.execute(text(f"PRAGMA incremental_vacuum({int(pages)})")).fetchall()
+        return conn.execute(text("PRAGMA freelist_count")).scalar()
@@ -0,0 +1,34 @@
+"""
+The spaCy models and similarity algorithms `[p]chatter model` and `[p]chatter algorithm`
+choose from, by position. Kept apart from the cog so tools can use them without Red
+"""
+
+from chatterbot.comparisons import JaccardSimilarity, LevenshteinDistance, SpacySimilarity
+
+
+class ENG_TRF:
+    ISO_639_1 = "en_core_web_trf"
+    ISO_639 = "eng"
+    ENGLISH_NAME = "English"
+
+
+class ENG_LG:
+    ISO_639_1 = "en_core_web_lg"
+    ISO_639 = "eng"
+    ENGLISH_NAME = "English"
+
+
+class ENG_MD:
+    ISO_639_1 = "en_core_web_md"
+    ISO_639 = "eng"
+    ENGLISH_NAME = "English"
+
+
+class ENG_SM:
+    ISO_639_1 = "en_core_web_sm"
+    ISO_639 = "eng"
+    ENGLISH_NAME = "English"
+
+
+MODELS = [ENG_SM, ENG_MD, ENG_LG, ENG_TRF]
+ALGORITHMS = [SpacySimilarity, JaccardSimilarity, LevenshteinDistance]
@@ -0,0 +1,120 @@
+"""
+Building chatbots and generating responses the way the cog does, without Red
+
+Everything here is blocking, the cog runs it in an executor.
+"""
+
+import logging
+import pathlib
+from typing import Dict, Optional
+
+from chatterbot import ChatBot
+from chatterbot.comparisons import SpacySimilarity
+from chatterbot.response_selection import get_random_response
+
+from chatter import spacy_models
+from chatter.stats import StageTimings, TimedComparison
+from chatter.vector_store import VectorSearch
+
+
+def create_chatbot(
+    data_path: pathlib.Path,
+    tagger_language,
+    similarity_algo,
+    similarity_threshold: float,
+    candidate_limit=300,
+    candidate_mode="terms",
+    vector_store=False,
+    timings: StageTimings = None,
+    logger: logging.Logger = None,
+) -> ChatBot:
+    """Builds and warms up a chatbot on the database at `data_path`"""
+    timings = timings or StageTimings()
+    kwargs = {"logger": logger} if logger is not None else {}
+    chatbot = ChatBot(
+        "ChatterBot",
+        # storage_adapter="chatterbot.storage.SQLStorageAdapter",
+        storage_adapter="chatter.storage_adapters.MyDumbSQLStorageAdapter",
+        database_uri="sqlite:///" + str(data_path),
+        statement_comparison_function=spacy_models.shared_comparison(similarity_algo),
+        response_selection_method=get_random_response,
+        logic_adapters=["chatterbot.logic.BestMatch"],
+        maximum_similarity_threshold=similarity_threshold,
+        tagger=spacy_models.SharedPosLemmaTagger,
+        tagger_language=tagger_language,
+        candidate_limit=candidate_limit,
+        candidate_mode=candidate_mode,
+        vector_store=vector_store and similarity_algo is SpacySimilarity,
+        timings=timings,
+        **kwargs,
+    )
+
+    if chatbot.storage.vector_store is not None:
+        search = VectorSearch(
+            chatbot,
+            chatbot.storage.vector_store,
+            similarity_threshold,
+            fallback=chatbot.search_algorithms["indexed_text_search"],
+        )
+        chatbot.search_algorithms[search.name] = search
+        for adapter in chatbot.logic_adapters:
+            adapter.search_algorithm = search
+
+    # Warm up, so the first message doesn't pay for lazy loading
+    Statement = chatbot.storage.get_object("statement")
+    chatbot.storage.tagger.get_text_index_string("Hello there")
+    chatbot.search_algorithms["indexed_text_search"].compare_statements(
+        Statement("Hello there"), Statement("General Kenobi")
+    )
+
+    text_search = chatbot.search_algorithms["indexed_text_search"]
+    text_search.compare_statements = TimedComparison(text_search.compare_statements, timings)
+
+    return chatbot
+
+
+def best_response(chatbot: ChatBot, statement):
+    """
+    Same as `ChatBot.generate_response` with a single logic adapter,
+    but returns the stored statement itself so its id and storage are known
+    """
+    response = max(
+        (
+            adapter.process(statement)
+            for adapter in chatbot.logic_adapters
+            if adapter.can_process(statement)
+        ),
+        key=lambda r: r.confidence,
+    )
+    response.storage = chatbot.storage
+    return response
+
+
+def generate_response(
+    chatbot: ChatBot,
+    statement,
+    corpus: Optional[ChatBot] = None,
+    similarity_threshold: float = 0.0,
+    timings: StageTimings = None,
+    stages: Dict[str, float] = None,
+):
+    """
+    Asks `chatbot` first, then `corpus` if that wasn't confident enough
+
+    Fills in `statement.search_text` if it's missing, so it can be reused for learning.
+    Stage timings are recorded in `timings` and added to `stages`
+    """
+    timings = timings or StageTimings()
+    if not statement.search_text:
+        with timings.time("reply.tagging", stages):
+            statement.search_text = chatbot.storage.tagger.get_text_index_string(statement.text)
+
+    with timings.time("reply.match", stages):
+        response = best_response(chatbot, statement)
+
+    if corpus is not None and corpus is not chatbot and response.confidence < similarity_threshold:
+        with timings.time("reply.shared_corpus", stages):
+            fallback = best_response(corpus, statement)
+        if fallback.confidence > response.confidence:
+            response = fallback
+    return response
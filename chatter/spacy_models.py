@@ -0,0 +1,97 @@
+"""
+One copy of each spaCy model per process
+
+ChatterBot's tagger, `SpacySimilarity` and `JaccardSimilarity` each call `spacy.load`,
+so every chatbot (and every guild shard) held the same model two or three times.
+Everything in the cog gets its model from `get_nlp` instead.
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from chatterbot.comparisons import Comparator, JaccardSimilarity, SpacySimilarity
+from chatterbot.tagging import PosLemmaTagger
+
+from chatter.tagging import punctuation_table
+
+log = logging.getLogger("red.fox_v3.chatter.spacy_models")
+
+# Only POS, lemmas, stop words and vectors are used, none of these
+DEFAULT_DISABLE = ("ner", "parser")
+
+_models: Dict[Tuple[str, Tuple[str, ...]], object] = {}
+_lock = threading.Lock()
+
+
+def get_nlp(name: str, disable: Sequence[str] = DEFAULT_DISABLE):
+    """The loaded model, loading it on first use. Safe to call from any thread"""
+    key = (name.lower(), tuple(sorted(disable)))
+    nlp = _models.get(key)
+    if nlp is None:
+        with _lock:
+            nlp = _models.get(key)  # Loaded by another thread while we waited
+            if nlp is None:
+                import spacy
+
+                started = time.perf_counter()
+                nlp = spacy.load(key[0], disable=list(key[1]))
+                _models[key] = nlp
+                log.info(f"Loaded {key[0]} in {time.perf_counter() - started:.1f}s")
+    return nlp
+
+
+def loaded_models() -> List[str]:
+    return [name for name, _ in _models]
+
+
+def release(keep: Iterable[str] = ()):
+    """
+    Forget every model not in `keep`, used after switching models
+
+    Memory is freed once nothing else refers to them anymore
+    """
+    keep = {name.lower() for name in keep}
+    with _lock:
+        for key in [key for key in _models if key[0] not in keep]:
+            log.info(f"Releasing {key[0]}")
+            del _models[key]
+
+
+class SharedPosLemmaTagger(PosLemmaTagger):
+    """`PosLemmaTagger` using the shared model. Pass as `tagger=` to the storage adapter"""
+
+    def __init__(self, language=None):
+        from chatterbot import languages
+
+        self.language = language or languages.ENG
+        self.punctuation_table = punctuation_table
+        self.nlp = get_nlp(self.language.ISO_639_1)
+
+
+class SharedSpacySimilarity(SpacySimilarity):
+    """`SpacySimilarity` using the shared model"""
+
+    def __init__(self, language):
+        Comparator.__init__(self, language)
+        self.nlp = get_nlp(self.language.ISO_639_1)
+
+
+class SharedJaccardSimilarity(JaccardSimilarity):
+    """`JaccardSimilarity` using the shared model"""
+
+    def __init__(self, language):
+        Comparator.__init__(self, language)
+        self.nlp = get_nlp(self.language.ISO_639_1)
+
+
+_SHARED_COMPARISONS = {
+    SpacySimilarity: SharedSpacySimilarity,
+    JaccardSimilarity: SharedJaccardSimilarity,
+}
+
+
+def shared_comparison(comparison):
+    """The shared model version of a comparison class, if it needs a model"""
+    return _SHARED_COMPARISONS.get(comparison, comparison)
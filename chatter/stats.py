@@ -0,0 +1,78 @@
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Optional
+
+
+class StageTimings:
+    """
+    Rolling timings of named stages, the last `samples` of each, in seconds
+
+    Safe to record from executor threads.
+    """
+
+    def __init__(self, samples=500):
+        self.samples = samples
+        self._timings: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.samples))
+        self._counts: Dict[str, int] = defaultdict(int)
+
+    def record(self, stage: str, seconds: float, into: Optional[Dict[str, float]] = None):
+        """Also adds the time to `into` when given, to collect the stages of one reply"""
+        self._timings[stage].append(seconds)
+        self._counts[stage] += 1
+        if into is not None:
+            into[stage] = into.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def time(self, stage: str, into: Optional[Dict[str, float]] = None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, into)
+
+    def clear(self):
+        self._timings.clear()
+        self._counts.clear()
+
+    def percentiles(self, stage: str) -> Dict[str, float]:
+        ordered = sorted(self._timings.get(stage, ()))
+        if not ordered:
+            return {}
+        values = {
+            f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+            for p in (50, 95, 99)
+        }
+        values["max"] = ordered[-1]
+        return values
+
+    def summary(self) -> str:
+        lines = [f"{'stage':<22}{'count':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+        for stage in sorted(self._timings):
+            values = self.percentiles(stage)
+            if not values:
+                continue
+            lines.append(
+                f"{stage:<22}{self._counts[stage]:>8}"
+                + "".join(f"{values[key] * 1000:>9.1f}" for key in ("p50", "p95", "p99", "max"))
+            )
+        return "\n".join(lines)
+
+
+class TimedComparison:
+    """Wraps a statement comparison function, timing every comparison"""
+
+    def __init__(self, comparison, timings: StageTimings, stage="similarity"):
+        self.comparison = comparison
+        self.timings = timings
+        self.stage = stage
+
+    def __call__(self, statement_a, statement_b):
+        started = time.perf_counter()
+        try:
+            return self.comparison(statement_a, statement_b)
+        finally:
+            self.timings.record(self.stage, time.perf_counter() - started)
+
+    def __getattr__(self, item):
+        return getattr(self.comparison, item)
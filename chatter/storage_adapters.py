@@ -1,10 +1,61 @@
+import logging
+import pathlib
+import threading
+import time
+from typing import Dict, List, Tuple
+
 from chatterbot.storage import StorageAdapter, SQLStorageAdapter
 
+log = logging.getLogger("red.fox_v3.chatter.storage")
+
 
 class MyDumbSQLStorageAdapter(SQLStorageAdapter):
+    """
+    SQLStorageAdapter with an inverted index over the search text
+
+    `filter` calls from the search algorithm only compare the `candidate_limit` statements
+    sharing the most search terms with the input, instead of every LIKE match.
+    With `candidate_mode="fts"` candidates come from a BM25 ranked FTS5 table instead,
+    kept in sync with triggers.
+
+    With `vector_store=True` the document vector of every statement is also computed once
+    and kept next to the database, see `chatter.vector_store`
+    """
+
+    # Filter parameters the candidate index knows how to apply itself
+    candidate_filter_kwargs = {"search_text_contains", "persona_not_startswith", "page_size"}
+
+    # Applied to every new sqlite connection
+    sqlite_pragmas = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # Negative is KiB, so 64 MiB
+        "temp_store": "MEMORY",
+    }
+
+    # Indexes for the lookups BestMatch and learning actually do, by name
+    statement_indexes = {
+        # Responses to the closest match
+        "ix_statement_search_in_response_to": "statement (search_in_response_to, id)",
+        # get_recent_repeated_responses, filter(conversation=..., order_by=["id"])
+        "ix_statement_conversation_id": "statement (conversation, id)",
+        # Exact text lookups from update and filter(text=...)
+        "ix_statement_text": "statement (text)",
+    }
+
     def __init__(self, **kwargs):
         super(SQLStorageAdapter, self).__init__(**kwargs)
 
+        self.candidate_limit = kwargs.get("candidate_limit", 300)  # 0 disables the index
+        self.candidate_mode = kwargs.get("candidate_mode", "terms")  # "terms" or "fts"
+        self.candidate_index_ready = False
+        self._fts_needs_rebuild = False
+        self.vector_store = None
+        self.vector_store_ready = False
+        self.vector_store_lock = threading.Lock()
+        self.timings = kwargs.get("timings")  # chatter.stats.StageTimings
+
         from sqlalchemy import create_engine, inspect
         from sqlalchemy.orm import sessionmaker
 
@@ -21,19 +72,499 @@ class MyDumbSQLStorageAdapter(SQLStorageAdapter):
         self.engine = create_engine(self.database_uri, connect_args={"check_same_thread": False})
 
         if self.database_uri.startswith("sqlite://"):
-            from sqlalchemy.engine import Engine
             from sqlalchemy import event
 
-            @event.listens_for(Engine, "connect")
+            # Only this engine, not every Engine in the bot
+            @event.listens_for(self.engine, "connect")
             def set_sqlite_pragma(dbapi_connection, connection_record):
-                dbapi_connection.execute("PRAGMA journal_mode=WAL")
-                dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+                for pragma, value in self.sqlite_pragmas.items():
+                    dbapi_connection.execute(f"PRAGMA {pragma}={value}")
 
         if not inspect(self.engine).has_table("Statement"):
             self.create_database()
 
+        self._create_candidate_index()
+        self._create_usage_table()
+        if self.candidate_mode == "fts":
+            self._create_fts_index()
+        else:
+            self._drop_fts_index()
+        self._new_statement_indexes = self._create_statement_indexes()
+
+        if kwargs.get("vector_store", False) and self.database_uri.startswith("sqlite:///"):
+            from chatter.vector_store import StatementVectorStore
+
+            db_path = pathlib.Path(self.database_uri[len("sqlite:///") :])
+            # One store per model, vectors from different models can't be compared
+            self.vector_store = StatementVectorStore(
+                db_path.with_name(f"{db_path.name}.{self.tagger.language.ISO_639_1}"),
+                self.tagger.nlp,
+            )
+
         self.Session = sessionmaker(bind=self.engine, expire_on_commit=True)
 
+    def _create_statement_indexes(self) -> bool:
+        """Creates missing indexes, returns whether any were new"""
+        from sqlalchemy import text
+
+        with self.engine.begin() as conn:
+            existing = {row[1] for row in conn.execute(text("PRAGMA index_list('statement')"))}
+            missing = [name for name in self.statement_indexes if name not in existing]
+            for name in missing:
+                log.info(f"Creating index {name}, this may take a while on large databases")
+                conn.execute(
+                    text(f"CREATE INDEX IF NOT EXISTS {name} ON {self.statement_indexes[name]}")
+                )
+
+            existing = {row[1] for row in conn.execute(text("PRAGMA index_list('statement')"))}
+
+        for name in self.statement_indexes:
+            if name not in existing:
+                log.warning(f"Index {name} is missing, lookups will be slow")
+
+        return bool(missing)
+
+    def analyze(self):
+        """Refresh the query planner statistics. Blocking, run this in an executor"""
+        from sqlalchemy import text
+
+        with self.engine.begin() as conn:
+            if self._new_statement_indexes:
+                conn.execute(text("ANALYZE"))
+                self._new_statement_indexes = False
+            else:
+                conn.execute(text("PRAGMA optimize"))  # Only re-analyzes what changed enough
+
+    def get_db_stats(self) -> dict:
+        """Table sizes, indexes and the query plans for the common lookups. Blocking"""
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+
+        stats = {"tables": {}, "sizes": {}, "indexes": {}, "plans": {}}
+        with self.engine.connect() as conn:
+            page_size = conn.execute(text("PRAGMA page_size")).scalar()
+            stats["file_size"] = page_size * conn.execute(text("PRAGMA page_count")).scalar()
+            stats["free_size"] = page_size * conn.execute(text("PRAGMA freelist_count")).scalar()
+
+            for table in ("statement", "tag", "statement_term"):
+                try:
+                    stats["tables"][table] = conn.execute(
+                        text(f"SELECT COUNT(*) FROM {table}")
+                    ).scalar()
+                except OperationalError:
+                    pass
+
+            try:  # Needs sqlite compiled with SQLITE_ENABLE_DBSTAT_VTAB
+                stats["sizes"] = dict(
+                    conn.execute(
+                        text("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC")
+                    ).fetchall()
+                )
+            except OperationalError:
+                pass
+
+            for row in conn.execute(
+                text("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'")
+            ):
+                stats["indexes"][row[0]] = row[1]
+
+            plans = {
+                "response lookup": (
+                    "SELECT * FROM statement WHERE search_in_response_to = :x",
+                    {"x": ""},
+                ),
+                "recent responses": (
+                    "SELECT * FROM statement WHERE conversation = :x ORDER BY id",
+                    {"x": ""},
+                ),
+                "text lookup": ("SELECT * FROM statement WHERE text = :x", {"x": ""}),
+                "search text scan": (
+                    "SELECT * FROM statement WHERE search_text LIKE :x",
+                    {"x": "%x%"},
+                ),
+                "candidate index": (
+                    "SELECT statement_id FROM statement_term WHERE term IN (:x, :y) "
+                    "GROUP BY statement_id ORDER BY COUNT(*) DESC LIMIT 10",
+                    {"x": "", "y": ""},
+                ),
+            }
+            for name, (query, params) in plans.items():
+                stats["plans"][name] = [
+                    row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {query}"), params)
+                ]
+
+        return stats
+
+    def _create_candidate_index(self):
+        from sqlalchemy import text
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS statement_term ("
+                    "term VARCHAR NOT NULL, "
+                    "statement_id INTEGER NOT NULL, "
+                    "PRIMARY KEY (term, statement_id)"
+                    ") WITHOUT ROWID"
+                )
+            )
+            # Needed to remove a deleted statement's terms
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_statement_term_statement_id "
+                    "ON statement_term (statement_id)"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS chatter_meta ("
+                    "key VARCHAR PRIMARY KEY, "
+                    "value INTEGER NOT NULL"
+                    ")"
+                )
+            )
+
+    def _create_usage_table(self):
+        from sqlalchemy import text
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS statement_usage ("
+                    "statement_id INTEGER PRIMARY KEY, "
+                    "last_matched DATETIME NOT NULL, "
+                    "hits INTEGER NOT NULL DEFAULT 0"
+                    ")"
+                )
+            )
+
+    def record_usage(self, usage: Dict[int, Tuple[str, int]]):
+        """Save when statements were last given as a response, {id: (last_matched, hits)}"""
+        from sqlalchemy import text
+
+        if not usage:
+            return
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO statement_usage (statement_id, last_matched, hits) "
+                    "VALUES (:statement_id, :last_matched, :hits) "
+                    "ON CONFLICT(statement_id) DO UPDATE SET "
+                    "last_matched = MAX(last_matched, excluded.last_matched), "
+                    "hits = hits + excluded.hits"
+                ),
+                [
+                    {"statement_id": statement_id, "last_matched": last_matched, "hits": hits}
+                    for statement_id, (last_matched, hits) in usage.items()
+                ],
+            )
+
+    def delete_statements(self, ids: List[int]):
+        """Deletes statements along with their tags, index terms and usage"""
+        from sqlalchemy import bindparam, text
+
+        if not ids:
+            return
+
+        with self.engine.begin() as conn:
+            for table in ("tag_association", "statement_term", "statement_usage", "statement"):
+                column = "id" if table == "statement" else "statement_id"
+                conn.execute(
+                    text(f"DELETE FROM {table} WHERE {column} IN :ids").bindparams(
+                        bindparam("ids", expanding=True)
+                    ),
+                    {"ids": ids},
+                )
+
+            # Without AUTOINCREMENT sqlite hands out ids above the highest remaining one again,
+            # so the indexes have to pick those up as new statements
+            last_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM statement")).scalar()
+            conn.execute(
+                text(
+                    "UPDATE chatter_meta SET value = :last_id "
+                    "WHERE key = 'candidate_indexed_to' AND value > :last_id"
+                ),
+                {"last_id": last_id},
+            )
+
+        if self.vector_store is not None:
+            with self.vector_store_lock:
+                self.vector_store.truncate_after(last_id)
+
+    def _create_fts_index(self):
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+
+        with self.engine.begin() as conn:
+            try:
+                # External content table, the text itself stays in `statement`
+                conn.execute(
+                    text(
+                        "CREATE VIRTUAL TABLE IF NOT EXISTS statement_fts USING fts5("
+                        "search_text, content='statement', content_rowid='id')"
+                    )
+                )
+            except OperationalError:
+                log.warning("This sqlite was built without FTS5, using the term index instead")
+                self.candidate_mode = "terms"
+                return
+
+            conn.execute(
+                text(
+                    "CREATE TRIGGER IF NOT EXISTS statement_fts_insert AFTER INSERT ON statement "
+                    "BEGIN "
+                    "INSERT INTO statement_fts (rowid, search_text) "
+                    "VALUES (new.id, new.search_text); "
+                    "END"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE TRIGGER IF NOT EXISTS statement_fts_delete AFTER DELETE ON statement "
+                    "BEGIN "
+                    "INSERT INTO statement_fts (statement_fts, rowid, search_text) "
+                    "VALUES ('delete', old.id, old.search_text); "
+                    "END"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE TRIGGER IF NOT EXISTS statement_fts_update "
+                    "AFTER UPDATE OF search_text ON statement "
+                    "BEGIN "
+                    "INSERT INTO statement_fts (statement_fts, rowid, search_text) "
+                    "VALUES ('delete', old.id, old.search_text); "
+                    "INSERT INTO statement_fts (rowid, search_text) "
+                    "VALUES (new.id, new.search_text); "
+                    "END"
+                )
+            )
+
+            # Existing statements are added by `build_candidate_index`, which sets this after.
+            # Until then only statements added through the triggers are searchable
+            rebuilt = conn.execute(
+                text("SELECT value FROM chatter_meta WHERE key = 'fts_rebuilt'")
+            ).scalar()
+
+        self._fts_needs_rebuild = not rebuilt
+
+    def _drop_fts_index(self):
+        """Stop paying for trigger updates when FTS isn't used"""
+        from sqlalchemy import text
+
+        with self.engine.begin() as conn:
+            for trigger in (
+                "statement_fts_insert",
+                "statement_fts_delete",
+                "statement_fts_update",
+            ):
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+            conn.execute(text("DROP TABLE IF EXISTS statement_fts"))
+            conn.execute(text("DELETE FROM chatter_meta WHERE key = 'fts_rebuilt'"))
+
+    def index_new_statements(self, batch_size=5000) -> int:
+        """
+        Add terms for one batch of statements that aren't in the candidate index yet
+
+        Returns the number of statements indexed, 0 once the index is caught up
+        """
+        from sqlalchemy import text
+
+        with self.engine.begin() as conn:
+            indexed_to = conn.execute(
+                text("SELECT value FROM chatter_meta WHERE key = 'candidate_indexed_to'")
+            ).scalar()
+            rows = conn.execute(
+                text(
+                    "SELECT id, search_text FROM statement WHERE id > :after ORDER BY id LIMIT :limit"
+                ),
+                {"after": indexed_to or 0, "limit": batch_size},
+            ).fetchall()
+
+            if not rows:
+                return 0
+
+            terms = [
+                {"term": term, "statement_id": statement_id}
+                for statement_id, search_text in rows
+                for term in set((search_text or "").split(" "))
+                if term
+            ]
+            if terms:
+                # Ignore duplicates, several threads may be indexing the same batch
+                conn.execute(
+                    text(
+                        "INSERT OR IGNORE INTO statement_term (term, statement_id) "
+                        "VALUES (:term, :statement_id)"
+                    ),
+                    terms,
+                )
+            conn.execute(
+                text(
+                    "INSERT INTO chatter_meta (key, value) VALUES ('candidate_indexed_to', :value) "
+                    "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)"
+                ),
+                {"value": rows[-1][0]},
+            )
+
+        return len(rows)
+
+    def _catch_up_candidate_index(self, batch_size=5000) -> int:
+        total = 0
+        while True:
+            count = self.index_new_statements(batch_size)
+            total += count
+            if count < batch_size:
+                return total
+
+    def build_candidate_index(self, batch_size=5000):
+        """Backfill the candidate index, blocking. Run this in an executor"""
+        if not self.candidate_limit:
+            return
+
+        if self.candidate_mode == "fts":
+            if self._fts_needs_rebuild:
+                from sqlalchemy import text
+
+                log.info("Building the full-text index, this may take a while")
+                with self.engine.begin() as conn:
+                    conn.execute(
+                        text("INSERT INTO statement_fts (statement_fts) VALUES ('rebuild')")
+                    )
+                    conn.execute(
+                        text(
+                            "INSERT INTO chatter_meta (key, value) VALUES ('fts_rebuilt', 1) "
+                            "ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+                        )
+                    )
+                self._fts_needs_rebuild = False
+            self.candidate_index_ready = True
+            return
+
+        total = self._catch_up_candidate_index(batch_size)
+        if total:
+            log.info(f"Candidate index backfilled {total} statements")
+        self.candidate_index_ready = True
+
+    def index_new_vectors(self, batch_size=1000) -> int:
+        """Compute vectors for one batch of statements missing from the vector store"""
+        from sqlalchemy import text
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text("SELECT id, text FROM statement WHERE id > :after ORDER BY id LIMIT :limit"),
+                {"after": self.vector_store.last_id(), "limit": batch_size},
+            ).fetchall()
+
+        if rows:
+            self.vector_store.add([row[0] for row in rows], [row[1] for row in rows])
+        return len(rows)
+
+    def _catch_up_vector_store(self, batch_size=1000) -> int:
+        total = 0
+        with self.vector_store_lock:  # Appends have to stay in id order
+            while True:
+                count = self.index_new_vectors(batch_size)
+                total += count
+                if count < batch_size:
+                    return total
+
+    def build_vector_store(self, batch_size=1000):
+        """Backfill the vector store, blocking. Run this in an executor"""
+        if self.vector_store is None:
+            return
+
+        total = self._catch_up_vector_store(batch_size)
+        if total:
+            log.info(f"Vector store backfilled {total} statements")
+        self.vector_store_ready = True
+
+    def build_indexes(self):
+        self.analyze()
+        self.build_candidate_index()
+        self.build_vector_store()
+
+    def _catch_up_indexes(self):
+        if self.candidate_index_ready and self.candidate_mode == "terms":
+            self._catch_up_candidate_index()
+        if self.vector_store_ready:
+            self._catch_up_vector_store()
+
+    def create(self, **kwargs):
+        statement = super().create(**kwargs)
+        self._catch_up_indexes()
+        return statement
+
+    def create_many(self, statements):
+        super().create_many(statements)
+        self._catch_up_indexes()
+
+    def _get_candidate_ids(self, search_text_contains: str):
+        from sqlalchemy import bindparam, text
+
+        terms = list({term for term in search_text_contains.split(" ") if term})[:500]
+        if not terms:
+            return []
+
+        if self.candidate_mode == "fts":
+            # Each term as a quoted phrase, "NOUN:dog" has to match as a whole
+            match = " OR ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+            query = text(
+                "SELECT rowid FROM statement_fts WHERE statement_fts MATCH :match "
+                "ORDER BY bm25(statement_fts) LIMIT :limit"
+            )
+            with self.engine.connect() as conn:
+                return [
+                    row[0]
+                    for row in conn.execute(query, {"match": match, "limit": self.candidate_limit})
+                ]
+
+        # Most shared terms first, newest statements break ties
+        query = text(
+            "SELECT statement_id FROM statement_term WHERE term IN :terms "
+            "GROUP BY statement_id ORDER BY COUNT(*) DESC, statement_id DESC LIMIT :limit"
+        ).bindparams(bindparam("terms", expanding=True))
+
+        with self.engine.connect() as conn:
+            return [
+                row[0]
+                for row in conn.execute(query, {"terms": terms, "limit": self.candidate_limit})
+            ]
+
+    def filter(self, **kwargs):
+        if (
+            not self.candidate_limit
+            or not self.candidate_index_ready
+            or not kwargs.get("search_text_contains")
+            or not self.candidate_filter_kwargs.issuperset(kwargs)
+        ):
+            yield from super().filter(**kwargs)
+            return
+
+        Statement = self.get_model("statement")
+
+        started = time.perf_counter()
+        candidate_ids = self._get_candidate_ids(kwargs["search_text_contains"])
+        if self.timings is not None:
+            self.timings.record("db.candidates", time.perf_counter() - started)
+        if not candidate_ids:
+            return
+
+        session = self.Session()
+        try:
+            query = session.query(Statement).filter(Statement.id.in_(candidate_ids))
+
+            persona_not_startswith = kwargs.get("persona_not_startswith")
+            if persona_not_startswith:
+                query = query.filter(~Statement.persona.startswith(persona_not_startswith))
+
+            # Same order the full scan would have compared them in
+            for statement in query.order_by(Statement.id):
+                yield self.model_to_object(statement)
+        finally:
+            session.close()
+
 
 class AsyncSQLStorageAdapter(SQLStorageAdapter):
     def __init__(self, **kwargs):
@@ -0,0 +1,59 @@
+import string
+from typing import List, Sequence
+
+punctuation_table = str.maketrans(dict.fromkeys(string.punctuation))
+
+# Set inside of tagging worker processes by `init_tagging_worker`
+_worker_nlp = None
+
+
+def _prepare_text(text: str) -> str:
+    if len(text) <= 2:
+        text_without_punctuation = text.translate(punctuation_table)
+        if len(text_without_punctuation) >= 1:
+            text = text_without_punctuation
+    return text
+
+
+def index_string_from_doc(text: str, document) -> str:
+    """
+    Same output as `PosLemmaTagger.get_text_index_string`, but from an already parsed document
+    """
+    bigram_pairs = []
+
+    if len(text) <= 2:
+        bigram_pairs = [token.lemma_.lower() for token in document]
+    else:
+        tokens = [token for token in document if token.is_alpha and not token.is_stop]
+
+        if len(tokens) < 2:
+            tokens = [token for token in document if token.is_alpha]
+
+        for index in range(1, len(tokens)):
+            bigram_pairs.append(f"{tokens[index - 1].pos_}:{tokens[index].lemma_.lower()}")
+
+    if not bigram_pairs:
+        bigram_pairs = [token.lemma_.lower() for token in document]
+
+    return " ".join(bigram_pairs)
+
+
+def pipe_text_index_strings(nlp, texts: Sequence[str], batch_size=256) -> List[str]:
+    """Tag many texts at once with `nlp.pipe` instead of one `nlp()` call per text"""
+    prepared = [_prepare_text(text) for text in texts]
+    return [
+        index_string_from_doc(text, document)
+        for text, document in zip(prepared, nlp.pipe(prepared, batch_size=batch_size))
+    ]
+
+
+def init_tagging_worker(model_name: str):
+    """Initializer for tagging worker processes, each worker holds its own model"""
+    global _worker_nlp
+    from chatter.spacy_models import get_nlp
+
+    _worker_nlp = get_nlp(model_name)
+
+
+def tag_in_worker(texts: Sequence[str]) -> List[str]:
+    return pipe_text_index_strings(_worker_nlp, texts)
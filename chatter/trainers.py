@@ -1,23 +1,359 @@
 import asyncio
 import csv
 import html
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import pathlib
+import sys
 import time
+from array import array
+from codecs import BOM_UTF8
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from typing import Dict, List, Optional
 
 from chatterbot import utils
 from chatterbot.conversation import Statement
-from chatterbot.tagging import PosLemmaTagger
 from chatterbot.trainers import Trainer
 from redbot.core.bot import Red
 from dateutil import parser as date_parser
 from redbot.core.utils import AsyncIter
+from redbot.core.utils.chat_formatting import humanize_timedelta
+
+from chatter.stats import StageTimings
+from chatter.tagging import init_tagging_worker, pipe_text_index_strings, tag_in_worker
 
 log = logging.getLogger("red.fox_v3.chatter.trainers")
 
 
+class TrainingCheckpoints:
+    """
+    Remembers how far each training file got, so an interrupted ingest can resume
+
+    Stored as a small json file next to the downloaded data
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+
+    def _read_all(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            log.warning(f"Corrupt training checkpoint file {self.path}, starting over")
+            return {}
+
+    def _write_all(self, data: Dict[str, Dict]):
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)  # Atomic, a crash mid-write keeps the old checkpoint
+
+    def load(self, key) -> Optional[Dict]:
+        return self._read_all().get(key)
+
+    def save(self, key, checkpoint: Dict):
+        data = self._read_all()
+        data[key] = checkpoint
+        self._write_all(data)
+
+    def clear(self, key):
+        data = self._read_all()
+        if data.pop(key, None) is not None:
+            self._write_all(data)
+
+
+class TrainingProgress:
+    """Logs progress and an ETA at most once every `interval` seconds"""
+
+    def __init__(self, name, total, start=0, interval=30):
+        self.name = name
+        self.total = max(total, 1)
+        self.start = start
+        self.interval = interval
+        self.start_time = time.monotonic()
+        self._last_report = self.start_time
+
+    def update(self, position, statements_written):
+        now = time.monotonic()
+        if now - self._last_report < self.interval:
+            return
+        self._last_report = now
+
+        done = position - self.start
+        elapsed = now - self.start_time
+        if done > 0:
+            eta = humanize_timedelta(seconds=int((self.total - position) * elapsed / done))
+        else:
+            eta = "unknown"
+        log.info(
+            f"{self.name}: {position / self.total:.1%} done, "
+            f"{statements_written} statements written, ETA {eta or 'now'}"
+        )
+
+
+def default_tagging_workers() -> int:
+    """One per core, leaving a core for the bot and the database writes"""
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+class TaggingPipeline:
+    """
+    Streams conversations to a pool of worker processes for tagging
+
+    Each worker loads its own spaCy model and tags a whole batch with `nlp.pipe`.
+    Every worker is another copy of the model in memory, see `default_tagging_workers`.
+    The main process only builds `Statement` objects and hands tagged batches
+    to `storage.create_many`, in the order they were added.
+    """
+
+    def __init__(
+        self,
+        chatbot,
+        workers: int = None,
+        batch_size: int = 2000,
+        max_pending=None,
+        on_flush=None,
+        timings: StageTimings = None,
+    ):
+        self.chatbot = chatbot
+        self.workers = workers or default_tagging_workers()
+        self.batch_size = batch_size
+        self.max_pending = max_pending or self.workers * 2
+        self.on_flush = on_flush  # Called with the batch checkpoint once it's committed
+        self.timings = timings or StageTimings()
+        self.loop = asyncio.get_event_loop()
+        self.statements_written = 0
+
+        self._pool = None
+        self._batch: List[List[Statement]] = []
+        self._batch_count = 0
+        self._batch_checkpoint = None
+        self._pending = deque()
+
+    async def __aenter__(self):
+        # Spawned workers need to be able to import this cog by name
+        cog_parent = str(pathlib.Path(__file__).resolve().parent.parent)
+        if cog_parent not in sys.path:
+            sys.path.append(cog_parent)
+
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_tagging_worker,
+            initargs=(self.chatbot.storage.tagger.language.ISO_639_1,),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                await self._submit()
+                while self._pending:
+                    await self._complete_oldest()
+        finally:
+            for future, *_ in self._pending:
+                future.cancel()
+            self._pending.clear()
+            await self.loop.run_in_executor(None, self._pool.shutdown)
+            self._pool = None
+
+    async def add_conversation(self, statements: List[Statement], checkpoint=None):
+        """
+        Queue one conversation of preprocessed statements, in order.
+
+        `search_text` and `search_in_response_to` are filled in by the pipeline
+        `checkpoint` is handed to `on_flush` once this conversation is in the database
+        """
+        if checkpoint is not None:
+            self._batch_checkpoint = checkpoint
+
+        if not statements:
+            return
+
+        self._batch.append(statements)
+        self._batch_count += len(statements)
+        if self._batch_count >= self.batch_size:
+            await self._submit()
+
+    async def _submit(self):
+        if not self._batch:
+            if self._batch_checkpoint is not None and self.on_flush is not None:
+                # Nothing left to write, but the position still moved forward
+                while self._pending:
+                    await self._complete_oldest()
+                await self.on_flush(self._batch_checkpoint, self.statements_written)
+                self._batch_checkpoint = None
+            return
+
+        batch = self._batch
+        checkpoint = self._batch_checkpoint
+        self._batch = []
+        self._batch_count = 0
+        self._batch_checkpoint = None
+
+        texts = [statement.text for conversation in batch for statement in conversation]
+        future = self.loop.run_in_executor(self._pool, tag_in_worker, texts)
+        self._pending.append((future, batch, checkpoint))
+
+        while len(self._pending) >= self.max_pending:
+            await self._complete_oldest()
+
+    async def _complete_oldest(self):
+        future, batch, checkpoint = self._pending.popleft()
+        with self.timings.time("train.tag_wait"):
+            search_texts = iter(await future)
+
+        statements = []
+        for conversation in batch:
+            previous_statement_search_text = ""
+            for statement in conversation:
+                statement.search_text = next(search_texts)
+                statement.search_in_response_to = previous_statement_search_text
+                previous_statement_search_text = statement.search_text
+                statements.append(statement)
+
+        with self.timings.time("train.write"):
+            await self.loop.run_in_executor(None, self.chatbot.storage.create_many, statements)
+        self.statements_written += len(statements)
+
+        if checkpoint is not None and self.on_flush is not None:
+            await self.on_flush(checkpoint, self.statements_written)
+
+
+class StreamingListTrainer(Trainer):
+    """
+    `ListTrainer` for conversations that arrive over time, like channel history
+
+    Three stages connected by bounded queues, so they all run at once:
+    conversations come in from the caller, get tagged in batches with `nlp.pipe`,
+    and are written with `create_many`, merging batches when writing falls behind.
+    """
+
+    def __init__(self, chatbot, batch_size=500, max_pending=4, **kwargs):
+        super().__init__(chatbot, **kwargs)
+        self.batch_size = batch_size  # Statements tagged at once
+        self.max_pending = max_pending  # Tagged batches waiting to be written
+        self.timings: StageTimings = kwargs.get("timings") or StageTimings()
+        self.loop = asyncio.get_event_loop()
+        self.conversations_trained = 0
+        self.statements_written = 0
+
+    def _tag(self, batch: List[List[str]]) -> List[Statement]:
+        """Blocking, same statements `ListTrainer.train` would create for each conversation"""
+        conversations = []
+        for conversation in batch:
+            statements = []
+            previous_statement_text = None
+            for text in conversation:
+                statement = self.get_preprocessed_statement(
+                    Statement(
+                        text=text,
+                        in_response_to=previous_statement_text,
+                        conversation="training",
+                    )
+                )
+                previous_statement_text = statement.text
+                statements.append(statement)
+            conversations.append(statements)
+
+        search_texts = iter(
+            pipe_text_index_strings(
+                self.chatbot.storage.tagger.nlp,
+                [statement.text for statements in conversations for statement in statements],
+            )
+        )
+
+        tagged = []
+        for statements in conversations:
+            previous_statement_search_text = ""
+            for statement in statements:
+                statement.search_text = next(search_texts)
+                statement.search_in_response_to = previous_statement_search_text
+                previous_statement_search_text = statement.search_text
+                tagged.append(statement)
+        return tagged
+
+    async def _write(self, tagged: asyncio.Queue):
+        done = False
+        while not done:
+            statements = await tagged.get()
+            if statements is None:
+                break
+            # Whatever else got tagged meanwhile goes in the same transaction
+            while not tagged.empty():
+                more = tagged.get_nowait()
+                if more is None:
+                    done = True
+                    break
+                statements.extend(more)
+
+            with self.timings.time("train.write"):
+                await self.loop.run_in_executor(None, self.chatbot.storage.create_many, statements)
+            self.statements_written += len(statements)
+
+    @staticmethod
+    async def _put(tagged: asyncio.Queue, writer: asyncio.Task, statements):
+        """Waits for room in the write queue, unless the writer failed and never makes any"""
+        put = asyncio.ensure_future(tagged.put(statements))
+        await asyncio.wait({put, writer}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            await writer  # Raises what it failed with
+
+    async def asynctrain(self, conversations: asyncio.Queue) -> int:
+        """
+        Trains on conversations (lists of strings) from the queue until `None`
+
+        Returns how many conversations were trained
+        """
+        tagged = asyncio.Queue(maxsize=self.max_pending)
+        writer = asyncio.create_task(self._write(tagged))
+
+        batch = []
+        batch_count = 0
+        finished = False
+        try:
+            while not finished:
+                conversation = await conversations.get()
+                if conversation is None:
+                    finished = True
+                elif len(conversation) > 1:  # TODO: Toggleable skipping short conversations
+                    batch.append(conversation)
+                    batch_count += len(conversation)
+
+                # Don't hold on to a small batch while waiting on Discord
+                if batch and (finished or batch_count >= self.batch_size or conversations.empty()):
+                    with self.timings.time("train.tag"):
+                        statements = await self.loop.run_in_executor(None, self._tag, batch)
+                    await self._put(tagged, writer, statements)
+                    self.conversations_trained += len(batch)
+                    log.info(
+                        f"Tagged {self.conversations_trained} conversations, "
+                        f"{self.statements_written} statements written"
+                    )
+                    batch = []
+                    batch_count = 0
+
+            await self._put(tagged, writer, None)
+            await writer
+        finally:
+            writer.cancel()
+
+        log.info(
+            f"Trained on {self.conversations_trained} conversations, "
+            f"{self.statements_written} statements"
+        )
+        return self.conversations_trained
+
+
 class KaggleTrainer(Trainer):
     def __init__(self, chatbot, datapath: pathlib.Path, **kwargs):
         super().__init__(chatbot, **kwargs)
@@ -29,6 +365,11 @@ class KaggleTrainer(Trainer):
             "Cornell-University/movie-dialog-corpus",
         )
 
+        self.workers = kwargs.get("workers", None)  # Tagging processes, None is one per core
+        self.timings: StageTimings = kwargs.get("timings") or StageTimings()
+
+        self.checkpoints = TrainingCheckpoints(self.data_directory / "checkpoints.json")
+
         # Create the data directory if it does not already exist
         if not os.path.exists(self.data_directory):
             os.makedirs(self.data_directory)
@@ -85,100 +426,131 @@ class MovieTrainer(KaggleTrainer):
             **kwargs,
         )
 
+    @staticmethod
+    def _index_movie_lines(lines_file) -> array:
+        """
+        Map each numeric line id (L1045 -> 1045) to the byte offset of its line.
+
+        A flat array instead of a dict of every utterance keeps memory small and steady
+        """
+        offsets = array("q")
+        offset = 0
+        for raw_line in lines_file:
+            line_id = raw_line.split(b"\t", 1)[0].strip(b'"').lstrip(BOM_UTF8)
+            try:
+                index = int(line_id[1:])
+            except ValueError:
+                log.debug(f"Bad line id {line_id}")
+            else:
+                if index >= len(offsets):
+                    offsets.extend([-1] * (index + 1 - len(offsets)))
+                offsets[index] = offset
+            offset += len(raw_line)
+        return offsets
+
+    @staticmethod
+    def _read_movie_line(lines_map: mmap.mmap, offsets: array, line_id: str) -> Optional[str]:
+        try:
+            offset = offsets[int(line_id[1:])]
+        except (ValueError, IndexError):
+            offset = -1
+        if offset < 0:
+            log.debug(f"Unknown line {line_id}")
+            return None
+
+        end = lines_map.find(b"\n", offset)
+        if end < 0:
+            end = len(lines_map)
+        line = lines_map[offset:end].decode("utf-8-sig")
+
+        _line = line.strip('"').split("\t")
+        if len(_line) < 5:  # Only good lines
+            log.debug(f"Bad line {_line}")
+            return None
+
+        return (
+            html.unescape(("".join(_line[4:])).strip())
+            .replace("<u>", "__")
+            .replace("</u>", "__")
+            .replace('""', '"')
+        )
+
     async def run_movie_training(self):
         dialogue_file = "movie_lines.tsv"
         conversation_file = "movie_conversations.tsv"
         log.info(f"Beginning dialogue training on {dialogue_file}")
         start_time = time.time()
 
-        tagger = PosLemmaTagger(language=self.chatbot.storage.tagger.language)
-
         # [lineID, characterID, movieID, character name, text of utterance]
         # File parsing from https://www.kaggle.com/mushaya/conversation-chatbot
-
-        with open(self.data_directory / conversation_file, "r", encoding="utf-8-sig") as conv_tsv:
-            conv_lines = conv_tsv.readlines()
-        with open(self.data_directory / dialogue_file, "r", encoding="utf-8-sig") as lines_tsv:
-            dialog_lines = lines_tsv.readlines()
-
-        # trans_dict = str.maketrans({"<u>": "__", "</u>": "__", '""': '"'})
-
-        lines_dict = {}
-        for line in dialog_lines:
-            _line = line[:-1].strip('"').split("\t")
-            if len(_line) >= 5:  # Only good lines
-                lines_dict[_line[0]] = (
-                    html.unescape(("".join(_line[4:])).strip())
-                    .replace("<u>", "__")
-                    .replace("</u>", "__")
-                    .replace('""', '"')
-                )
-            else:
-                log.debug(f"Bad line {_line}")
-
-        # collecting line ids for each conversation
-        conv = []
-        for line in conv_lines[:-1]:
-            _line = line[:-1].split("\t")[-1][1:-1].replace("'", "").replace(" ", ",")
-            conv.append(_line.split(","))
-
-        # conversations = csv.reader(conv_tsv, delimiter="\t")
-        #
-        # reader = csv.reader(lines_tsv, delimiter="\t")
-        #
-        #
-        #
-        # lines_dict = {}
-        # for row in reader:
-        #     try:
-        #         lines_dict[row[0].strip('"')] = row[4]
-        #     except:
-        #         log.exception(f"Bad line: {row}")
-        #         pass
-        #     else:
-        #         # log.info(f"Good line: {row}")
-        #         pass
-        #
-        # # lines_dict = {row[0].strip('"'): row[4] for row in reader_list}
-
-        statements_from_file = []
-        save_every = 300
-        count = 0
-
-        # [characterID of first, characterID of second, movieID, list of utterances]
-        async for lines in AsyncIter(conv):
-            previous_statement_text = None
-            previous_statement_search_text = ""
-
-            for line in lines:
-                text = lines_dict[line]
-                statement = Statement(
-                    text=text,
-                    in_response_to=previous_statement_text,
-                    conversation="training",
-                )
-
-                for preprocessor in self.chatbot.preprocessors:
-                    statement = preprocessor(statement)
-
-                statement.search_text = tagger.get_text_index_string(statement.text)
-                statement.search_in_response_to = previous_statement_search_text
-
-                previous_statement_text = statement.text
-                previous_statement_search_text = statement.search_text
-
-                statements_from_file.append(statement)
-
-            count += 1
-            if count >= save_every:
-                if statements_from_file:
-                    self.chatbot.storage.create_many(statements_from_file)
-                    statements_from_file = []
-                count = 0
-
-        if statements_from_file:
-            self.chatbot.storage.create_many(statements_from_file)
-
+        # Utterances are read straight out of the memory-mapped file when a conversation needs them
+
+        conversation_path = self.data_directory / conversation_file
+        conversation_size = os.path.getsize(conversation_path)
+
+        checkpoint = self.checkpoints.load(conversation_file) or {}
+        start_offset = checkpoint.get("offset", 0)
+        if start_offset:
+            log.info(f"Resuming {conversation_file} at byte {start_offset}")
+
+        progress = TrainingProgress(conversation_file, conversation_size, start=start_offset)
+
+        async def on_flush(batch_checkpoint, statements_written):
+            self.checkpoints.save(conversation_file, batch_checkpoint)
+            progress.update(batch_checkpoint["offset"], statements_written)
+
+        with open(self.data_directory / dialogue_file, "rb") as lines_tsv, open(
+            conversation_path, "rb"
+        ) as conv_tsv:
+            offsets = await asyncio.get_event_loop().run_in_executor(
+                None, self._index_movie_lines, lines_tsv
+            )
+            lines_map = mmap.mmap(lines_tsv.fileno(), 0, access=mmap.ACCESS_READ)
+
+            conv_tsv.seek(start_offset)
+
+            def read_conversations():
+                # [characterID of first, characterID of second, movieID, list of utterances]
+                offset = start_offset
+                for raw_line in conv_tsv:
+                    offset += len(raw_line)
+                    line = raw_line.decode("utf-8-sig").rstrip("\r\n")
+                    if not line:
+                        continue
+                    _line = line.split("\t")[-1][1:-1].replace("'", "").replace(" ", ",")
+                    yield offset, [line_id for line_id in _line.split(",") if line_id]
+
+            try:
+                async with TaggingPipeline(
+                    self.chatbot, workers=self.workers, on_flush=on_flush, timings=self.timings
+                ) as pipeline:
+                    async for offset, lines in AsyncIter(read_conversations(), steps=100):
+                        previous_statement_text = None
+                        conversation = []
+
+                        for line in lines:
+                            text = self._read_movie_line(lines_map, offsets, line)
+                            if text is None:
+                                continue
+                            statement = Statement(
+                                text=text,
+                                in_response_to=previous_statement_text,
+                                conversation="training",
+                            )
+
+                            for preprocessor in self.chatbot.preprocessors:
+                                statement = preprocessor(statement)
+
+                            previous_statement_text = statement.text
+                            conversation.append(statement)
+
+                        await pipeline.add_conversation(
+                            conversation, checkpoint={"offset": offset}
+                        )
+            finally:
+                lines_map.close()
+
+        self.checkpoints.clear(conversation_file)  # Finished, next run starts over
         log.info(f"Training took {time.time() - start_time} seconds.")
 
     async def asynctrain(self, *args, **kwargs):
@@ -251,57 +623,89 @@ class UbuntuCorpusTrainer2(KaggleTrainer):
         log.info(f"Beginning dialogue training on {dialogue_file}")
         start_time = time.time()
 
-        tagger = PosLemmaTagger(language=self.chatbot.storage.tagger.language)
-
-        with open(extracted_dir / dialogue_file, "r", encoding="utf-8") as dg:
-            reader = csv.DictReader(dg)
-
-            next(reader)  # Skip the header
-
-            last_dialogue_id = None
-            previous_statement_text = None
-            previous_statement_search_text = ""
-            statements_from_file = []
-
-            save_every = 50
-            count = 0
-
-            async for row in AsyncIter(reader):
-                dialogue_id = row["dialogueID"]
-                if dialogue_id != last_dialogue_id:
-                    previous_statement_text = None
-                    previous_statement_search_text = ""
-                    last_dialogue_id = dialogue_id
-                    count += 1
-                    if count >= save_every:
-                        if statements_from_file:
-                            self.chatbot.storage.create_many(statements_from_file)
-                            statements_from_file = []
-                        count = 0
-
-                if len(row) > 0:
-                    statement = Statement(
-                        text=row["text"],
-                        in_response_to=previous_statement_text,
-                        conversation="training",
-                        # created_at=date_parser.parse(row["date"]),
-                        persona=row["from"],
-                    )
-
-                    for preprocessor in self.chatbot.preprocessors:
-                        statement = preprocessor(statement)
-
-                    statement.search_text = tagger.get_text_index_string(statement.text)
-                    statement.search_in_response_to = previous_statement_search_text
-
-                    previous_statement_text = statement.text
-                    previous_statement_search_text = statement.search_text
-
-                    statements_from_file.append(statement)
-
-            if statements_from_file:
-                self.chatbot.storage.create_many(statements_from_file)
+        file_path = extracted_dir / dialogue_file
+        file_size = os.path.getsize(file_path)
+
+        checkpoint = self.checkpoints.load(dialogue_file) or {}
+        start_offset = checkpoint.get("offset", 0)
+        resume_after_dialogue = checkpoint.get("dialogue_id")
+        if start_offset:
+            log.info(
+                f"Resuming {dialogue_file} at byte {start_offset} "
+                f"after dialogue {resume_after_dialogue}"
+            )
+
+        progress = TrainingProgress(dialogue_file, file_size, start=start_offset)
+
+        async def on_flush(batch_checkpoint, statements_written):
+            self.checkpoints.save(dialogue_file, batch_checkpoint)
+            progress.update(batch_checkpoint["offset"], statements_written)
+
+        position = {"offset": start_offset}
+
+        def read_lines(f):
+            # csv only pulls as many lines as the current row needs,
+            # so the offset is always the end of the last row returned
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                position["offset"] = f.tell()
+                yield line.decode("utf-8")
+
+        async with TaggingPipeline(
+            self.chatbot, workers=self.workers, on_flush=on_flush, timings=self.timings
+        ) as pipeline:
+            with open(file_path, "rb") as dg:
+                if start_offset:
+                    fieldnames = next(csv.reader([dg.readline().decode("utf-8")]))
+                    dg.seek(start_offset)
+                    reader = csv.DictReader(read_lines(dg), fieldnames=fieldnames)
+                else:
+                    reader = csv.DictReader(read_lines(dg))
+                    next(reader)  # Skip the header
+
+                last_dialogue_id = resume_after_dialogue
+                previous_statement_text = None
+                conversation = []
+                row_end = position["offset"]
+
+                async for row in AsyncIter(reader, steps=500):
+                    row_start, row_end = row_end, position["offset"]
+                    dialogue_id = row["dialogueID"]
+                    if dialogue_id == resume_after_dialogue:
+                        continue  # Already committed before the restart
+                    resume_after_dialogue = None
+
+                    if dialogue_id != last_dialogue_id:
+                        await pipeline.add_conversation(
+                            conversation,
+                            checkpoint={"offset": row_start, "dialogue_id": last_dialogue_id},
+                        )
+                        conversation = []
+                        previous_statement_text = None
+                        last_dialogue_id = dialogue_id
+
+                    if len(row) > 0:
+                        statement = Statement(
+                            text=row["text"],
+                            in_response_to=previous_statement_text,
+                            conversation="training",
+                            # created_at=date_parser.parse(row["date"]),
+                            persona=row["from"],
+                        )
+
+                        for preprocessor in self.chatbot.preprocessors:
+                            statement = preprocessor(statement)
+
+                        previous_statement_text = statement.text
+                        conversation.append(statement)
+
+                await pipeline.add_conversation(
+                    conversation, checkpoint={"offset": row_end, "dialogue_id": last_dialogue_id}
+                )
 
+        self.checkpoints.clear(dialogue_file)  # Finished, next run starts over
         log.info(f"Training took {time.time() - start_time} seconds.")
 
 
@@ -0,0 +1,151 @@
+import logging
+import os
+import pathlib
+import threading
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from chatterbot.conversation import Statement
+
+log = logging.getLogger("red.fox_v3.chatter.vector_store")
+
+
+class StatementVectorStore:
+    """
+    Document vectors for every statement, computed once and kept in two sidecar files
+
+    `<prefix>.ids` holds int64 statement ids and `<prefix>.f32` the matching
+    L2 normalized float32 rows, so cosine similarity is a single dot product
+    over a memory-mapped matrix.
+    """
+
+    def __init__(self, path_prefix: pathlib.Path, nlp):
+        self.ids_path = path_prefix.with_name(path_prefix.name + ".ids")
+        self.matrix_path = path_prefix.with_name(path_prefix.name + ".f32")
+        self.nlp = nlp
+        self.dim = len(nlp("dimension").vector)
+
+        self._lock = threading.Lock()
+        self._ids: Optional[np.ndarray] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._repair()
+
+    def _rows_on_disk(self) -> int:
+        try:
+            id_rows = os.path.getsize(self.ids_path) // 8
+            matrix_rows = os.path.getsize(self.matrix_path) // (4 * self.dim)
+        except FileNotFoundError:
+            return 0
+        return min(id_rows, matrix_rows)
+
+    def _repair(self):
+        """Drop a half written row from a crash so both files line up again"""
+        rows = self._rows_on_disk()
+        for path, row_size in ((self.ids_path, 8), (self.matrix_path, 4 * self.dim)):
+            if path.exists() and os.path.getsize(path) != rows * row_size:
+                log.warning(f"Truncating {path} to {rows} rows")
+                with open(path, "r+b") as f:
+                    f.truncate(rows * row_size)
+
+    def _load(self):
+        rows = self._rows_on_disk()
+        if self._ids is not None and len(self._ids) == rows:
+            return
+        if rows == 0:
+            self._ids = np.empty(0, dtype=np.int64)
+            self._matrix = np.empty((0, self.dim), dtype=np.float32)
+            return
+        self._ids = np.memmap(self.ids_path, dtype=np.int64, mode="r", shape=(rows,))
+        self._matrix = np.memmap(
+            self.matrix_path, dtype=np.float32, mode="r", shape=(rows, self.dim)
+        )
+
+    def vectorize(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, document in enumerate(self.nlp.pipe(texts, batch_size=256)):
+            norm = document.vector_norm
+            if norm:  # Zero vectors stay zero, spaCy calls those 0.0 similar to everything
+                matrix[row] = document.vector / norm
+        return matrix
+
+    def last_id(self) -> int:
+        with self._lock:
+            self._load()
+            return int(self._ids[-1]) if len(self._ids) else 0
+
+    def add(self, ids: Sequence[int], texts: Sequence[str]):
+        matrix = self.vectorize(texts)
+        with self._lock:
+            with open(self.matrix_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(self.ids_path, "ab") as f:
+                f.write(np.asarray(ids, dtype=np.int64).tobytes())
+
+    def truncate_after(self, last_id: int) -> int:
+        """
+        Drops the vectors of statements after `last_id`, returns how many
+
+        Used after deleting statements, sqlite gives their ids to new statements again
+        """
+        with self._lock:
+            self._load()
+            keep = int(np.searchsorted(self._ids, last_id, side="right"))
+            removed = len(self._ids) - keep
+            if removed:
+                self._ids = self._matrix = None  # Let go of the maps before cutting the files
+                for path, row_size in ((self.ids_path, 8), (self.matrix_path, 4 * self.dim)):
+                    with open(path, "r+b") as f:
+                        f.truncate(keep * row_size)
+                log.info(f"Dropped {removed} vectors after statement {last_id}")
+        return removed
+
+    def similarities(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the statement ids and their cosine similarity to `text`"""
+        vector = self.vectorize([text])[0]
+        # Under the lock, the files may be truncated as soon as it's released
+        with self._lock:
+            self._load()
+            return np.array(self._ids), self._matrix @ vector
+
+
+class VectorSearch:
+    """
+    Drop-in replacement for chatterbot's IndexedTextSearch using a `StatementVectorStore`
+
+    Yields the same statement BestMatch would settle on when comparing with SpacySimilarity:
+    the first statement reaching the threshold, otherwise the most similar one.
+    Until the store is backfilled, searches go to the `fallback` search algorithm.
+    """
+
+    name = "vector_search"
+
+    def __init__(self, chatbot, store: StatementVectorStore, threshold: float, fallback):
+        self.chatbot = chatbot
+        self.store = store
+        self.threshold = threshold
+        self.fallback = fallback
+
+    def search(self, input_statement: Statement, **additional_parameters):
+        if not self.chatbot.storage.vector_store_ready:
+            yield from self.fallback.search(input_statement, **additional_parameters)
+            return
+
+        ids, scores = self.store.similarities(input_statement.text)
+        scores = np.array(scores)  # Writable copy, excluded rows get knocked out below
+
+        while len(scores):
+            above = np.flatnonzero(scores >= self.threshold)
+            index = int(above[0]) if len(above) else int(np.argmax(scores))
+            confidence = float(scores[index])
+            if confidence <= 0:
+                return
+
+            matches = list(self.chatbot.storage.filter(id=int(ids[index])))
+            if matches and not matches[0].persona.startswith("bot:"):
+                statement = matches[0]
+                statement.confidence = confidence
+                self.chatbot.logger.info(f"Similar text found: {statement.text} {confidence}")
+                yield statement
+                return
+
+            scores[index] = -1  # Deleted or a bot statement, try the next best
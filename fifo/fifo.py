@@ -1,7 +1,8 @@
+import asyncio
 import itertools
 import logging
 from datetime import MAXYEAR, datetime, timedelta, tzinfo
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 
 import discord
 import pytz
@@ -13,7 +14,8 @@ from apscheduler.util import localize
 from redbot.core import Config, checks, commands
 from redbot.core.bot import Red
 from redbot.core.commands import TimedeltaConverter
-from redbot.core.utils.chat_formatting import humanize_timedelta, pagify
+from redbot.core.data_manager import cog_data_path
+from redbot.core.utils.chat_formatting import box, humanize_timedelta, pagify
 from tzlocal import get_localzone
 
 from .datetime_cron_converters import (
@@ -21,6 +23,7 @@ from .datetime_cron_converters import (
     DatetimeConverter,
     TimezoneConverter,
 )
+from .stats import SchedulerStats, append_records
 from .task import Task
 
 schedule_log = logging.getLogger("red.fox_v3.fifo.scheduler")
@@ -31,9 +34,15 @@ log = logging.getLogger("red.fox_v3.fifo")
 
 async def _execute_task(**task_state):
     log.info(f"Executing {task_state.get('name')}")
-    task = Task(**task_state)
-    if await task.load_from_config():
-        return await task.execute()
+    cog = task_state["bot"].get_cog("FIFO") if task_state.get("bot") is not None else None
+    if cog is not None:
+        task = await cog._get_loaded_task(task_state["name"], task_state["guild_id"])
+        if task is not None:
+            return await task.execute()
+    else:
+        task = Task(**task_state)
+        if await task.load_from_config():
+            return await task.execute()
     log.warning(f"Failed to load data on {task_state=}")
     return False
 
@@ -89,7 +98,11 @@ class FIFO(commands.Cog):
         self.bot = bot
         self.config = Config.get_conf(self, identifier=70737079, force_registration=True)
 
-        default_global = {"jobs": []}
+        default_global = {
+            "jobs": [],  # Pre-migration format
+            "jobs_by_id": {},
+            "stats_file": False,
+        }
         default_guild = {"tasks": {}}
 
         self.config.register_global(**default_global)
@@ -98,6 +111,12 @@ class FIFO(commands.Cog):
         self.scheduler: Optional[AsyncIOScheduler] = None
         self.jobstore = None
 
+        # Loaded tasks by job id, so frequent tasks don't go through Config on every run
+        self._tasks: Dict[str, Task] = {}
+
+        self.stats = SchedulerStats()
+        self._stats_task: Optional[asyncio.Task] = None
+
         self.tz_cog = None
 
     async def red_delete_data_for_user(self, **kwargs):
@@ -108,6 +127,9 @@ class FIFO(commands.Cog):
         # self.scheduler.remove_all_jobs()
         if self.scheduler is not None:
             self.scheduler.shutdown()
+        self.stats.detach()
+        if self._stats_task is not None:
+            self._stats_task.cancel()
 
     async def initialize(self):
         job_defaults = {
@@ -130,8 +152,24 @@ class FIFO(commands.Cog):
         await self.jobstore.load_from_config()
         self.scheduler.add_jobstore(self.jobstore, "default")
 
+        self.stats.attach(self.scheduler)
+        self.stats.keep_records = await self.config.stats_file()
+        self._stats_task = asyncio.create_task(self._write_stats_loop())
+
         self.scheduler.start()
 
+    async def _write_stats_loop(self, interval=60):
+        """Appends scheduler events to stats.jsonl, while `[p]fifo statsfile` is on"""
+        path = cog_data_path(self) / "stats.jsonl"
+        while True:
+            await asyncio.sleep(interval)
+            records = self.stats.drain()
+            if records:
+                try:
+                    await self.bot.loop.run_in_executor(None, append_records, path, records)
+                except OSError:
+                    log.exception(f"Failed to write {len(records)} stats records to {path}")
+
     async def _check_parsable_command(self, ctx: commands.Context, command_to_parse: str):
         message: discord.Message = ctx.message
 
@@ -142,12 +180,28 @@ class FIFO(commands.Cog):
 
         return new_ctx.valid
 
+    async def _get_loaded_task(self, task_name, guild_id) -> Optional[Task]:
+        """The task ready to execute, loaded from Config only the first time"""
+        job_id = _assemble_job_id(task_name, guild_id)
+        task = self._tasks.get(job_id)
+        if task is None:
+            task = Task(task_name, guild_id, self.config, bot=self.bot)
+            if not await task.load_from_config():
+                return None
+            self._tasks[job_id] = task
+        return task
+
+    def _forget_task(self, task: Task):
+        """Call whenever a task's data is changed, so the next run loads it again"""
+        self._tasks.pop(_assemble_job_id(task.name, task.guild_id), None)
+
     async def _delete_task(self, task: Task):
         job: Union[Job, None] = await self._get_job(task)
         if job is not None:
             job.remove()
 
         await task.delete_self()
+        self._forget_task(task)
 
     async def _process_task(self, task: Task):
         # None of this is necessar, we have `replace_existing` already
@@ -159,6 +213,7 @@ class FIFO(commands.Cog):
         #     else:
         #         job.reschedule(combined_trigger_)
         #     return job
+        self._forget_task(task)
         return await self._add_job(task)
 
     async def _get_job(self, task: Task) -> Job:
@@ -223,7 +278,9 @@ class FIFO(commands.Cog):
         """Debug command to clear all current fifo data"""
         self.scheduler.remove_all_jobs()
         await self.config.guild(ctx.guild).tasks.clear()
+        self._tasks.clear()
         await self.config.jobs.clear()
+        await self.config.jobs_by_id.clear()
         # await self.config.jobs_index.clear()
         await ctx.tick()
 
@@ -309,6 +366,7 @@ class FIFO(commands.Cog):
             await ctx.maybe_send_embed("Unsupported result")
             return
 
+        self._forget_task(task)
         await ctx.tick()
 
     @fifo.command(name="resume")
@@ -463,6 +521,45 @@ class FIFO(commands.Cog):
         else:
             await ctx.maybe_send_embed("Failed to get schedule from scheduler")
 
+    @fifo.command(name="stats")
+    async def fifo_stats(self, ctx: commands.Context, clear: bool = False):
+        """
+        Show how each task has been running since the cog loaded
+
+        ok, fail and err are runs that worked, couldn't start, and raised an error.
+        miss are runs later than the grace time, coal are runs dropped by coalescing,
+        maxi are runs skipped because the max instances were already running.
+        peak is the most runs at once, lag is how late runs started and run is how long they took,
+        in seconds over the latest 200 runs.
+
+        Pass True to reset them.
+        """
+        if clear:
+            self.stats.clear()
+            await ctx.tick()
+            return
+
+        out = self.stats.summary()
+        for page in pagify(out, delims=["\n"], page_length=1900):
+            await ctx.send(box(page))
+
+    @fifo.command(name="statsfile")
+    async def fifo_statsfile(self, ctx: commands.Context, enabled: bool):
+        """
+        Toggle appending every scheduler event to stats.jsonl in the cog's data folder
+
+        Written once a minute, for tuning grace times and max instances over longer periods
+        """
+        await self.config.stats_file.set(enabled)
+        self.stats.keep_records = enabled
+        if not enabled:
+            self.stats.drain()
+        await ctx.maybe_send_embed(
+            f"Writing stats to {cog_data_path(self) / 'stats.jsonl'}"
+            if enabled
+            else "No longer writing stats"
+        )
+
     @fifo.command(name="add")
     async def fifo_add(self, ctx: commands.Context, task_name: str, *, command_to_execute: str):
         """
@@ -492,6 +589,7 @@ class FIFO(commands.Cog):
         )
         await task.set_commmand_str(command_to_execute)
         await task.save_all()
+        self._forget_task(task)
         await ctx.tick()
 
     @fifo.command(name="delete")
@@ -530,6 +628,7 @@ class FIFO(commands.Cog):
 
         await task.clear_triggers()
         await self._remove_job(task)
+        self._forget_task(task)
         await ctx.tick()
 
     @fifo.group(name="addtrigger", aliases=["trigger"])
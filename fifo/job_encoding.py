@@ -0,0 +1,161 @@
+"""
+JSON friendly encoding of the triggers FIFO schedules
+
+Jobs used to be stored as base64 pickles of `Job.__getstate__()`, which break
+when APScheduler or the cog changes and are slow to load in bulk.
+Triggers are stored as plain dicts instead, built back through each trigger's `__setstate__`.
+Every encoding is decoded again and compared with the original trigger's state,
+triggers that don't come back the same are refused so they keep being pickled.
+"""
+
+from datetime import datetime, timedelta, tzinfo
+from typing import Dict, Optional
+
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.combining import OrTrigger
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.util import astimezone, datetime_to_utc_timestamp
+
+from fifo.date_trigger import CustomDateTrigger
+
+JOB_FORMAT_VERSION = 2  # 1 is the pickle format
+
+
+class UnsupportedTrigger(ValueError):
+    pass
+
+
+def _timezone_name(tz) -> str:
+    """Name that `astimezone` turns back into the same timezone"""
+    name = getattr(tz, "zone", None) or getattr(tz, "key", None) or str(tz)  # pytz or zoneinfo
+    try:
+        astimezone(name)
+    except Exception:
+        raise UnsupportedTrigger(f"Can't encode timezone {tz!r}")
+    return name
+
+
+def _encode_date(dt: Optional[datetime]) -> Optional[float]:
+    return datetime_to_utc_timestamp(dt)
+
+
+def _decode_date(timestamp: Optional[float], tz) -> Optional[datetime]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz)
+
+
+def _comparable_state(value):
+    """Trigger state with timezones replaced by their names, pytz and zoneinfo compare equal"""
+    if isinstance(value, dict):
+        return {key: _comparable_state(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_comparable_state(item) for item in value]
+    if isinstance(value, tzinfo):
+        return getattr(value, "zone", None) or getattr(value, "key", None) or str(value)
+    return value
+
+
+def encode_trigger(trigger: BaseTrigger) -> Dict:
+    """
+    Raises `UnsupportedTrigger` for triggers FIFO doesn't create,
+    or that wouldn't decode back to the same state
+    """
+    data = _encode_trigger(trigger)
+    try:
+        same = _comparable_state(decode_trigger(data).__getstate__()) == _comparable_state(
+            trigger.__getstate__()
+        )
+    except Exception as e:
+        raise UnsupportedTrigger(f"Can't decode {trigger!r} again: {e}")
+    if not same:
+        raise UnsupportedTrigger(f"{trigger!r} doesn't decode back the same")
+    return data
+
+
+def _encode_trigger(trigger: BaseTrigger) -> Dict:
+    if isinstance(trigger, OrTrigger):
+        return {
+            "type": "or",
+            "triggers": [_encode_trigger(t) for t in trigger.triggers],
+            "jitter": trigger.jitter,
+        }
+
+    if isinstance(trigger, IntervalTrigger):
+        return {
+            "type": "interval",
+            "seconds": trigger.interval.total_seconds(),
+            "timezone": _timezone_name(trigger.timezone),
+            "start_date": _encode_date(trigger.start_date),
+            "end_date": _encode_date(trigger.end_date),
+            "jitter": trigger.jitter,
+        }
+
+    if isinstance(trigger, CronTrigger):
+        return {
+            "type": "cron",
+            "fields": {field.name: str(field) for field in trigger.fields},
+            "timezone": _timezone_name(trigger.timezone),
+            "start_date": _encode_date(trigger.start_date),
+            "end_date": _encode_date(trigger.end_date),
+            "jitter": trigger.jitter,
+        }
+
+    if isinstance(trigger, DateTrigger):
+        return {
+            "type": "date",
+            "custom": isinstance(trigger, CustomDateTrigger),
+            "run_date": _encode_date(trigger.run_date),
+            "timezone": _timezone_name(trigger.run_date.tzinfo),
+        }
+
+    raise UnsupportedTrigger(f"Can't encode {trigger.__class__.__name__}")
+
+
+def decode_trigger(data: Dict) -> BaseTrigger:
+    if data["type"] == "or":
+        trigger = OrTrigger.__new__(OrTrigger)
+        trigger.triggers = [decode_trigger(t) for t in data["triggers"]]
+        trigger.jitter = data["jitter"]
+        return trigger
+
+    if data["type"] == "date":
+        trigger_class = CustomDateTrigger if data["custom"] else DateTrigger
+        trigger = trigger_class.__new__(trigger_class)
+        trigger.__setstate__(
+            {
+                "version": 1,
+                "run_date": _decode_date(data["run_date"], astimezone(data["timezone"])),
+            }
+        )
+        return trigger
+
+    tz = astimezone(data["timezone"])
+    state = {
+        "version": 2,
+        "timezone": tz,
+        "start_date": _decode_date(data["start_date"], tz),
+        "end_date": _decode_date(data["end_date"], tz),
+        "jitter": data["jitter"],
+    }
+
+    if data["type"] == "interval":
+        trigger = IntervalTrigger.__new__(IntervalTrigger)
+        state["interval"] = timedelta(seconds=data["seconds"])
+        trigger.__setstate__(state)
+        return trigger
+
+    if data["type"] == "cron":
+        # Every field is given, so the defaults filled in for missing fields don't matter
+        trigger = CronTrigger(
+            **data["fields"],
+            start_date=state["start_date"],
+            end_date=state["end_date"],
+            timezone=tz,
+            jitter=data["jitter"],
+        )
+        return trigger
+
+    raise UnsupportedTrigger(f"Unknown trigger type {data['type']}")
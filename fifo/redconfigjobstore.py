@@ -2,17 +2,25 @@ import asyncio
 import base64
 import logging
 import pickle
+from typing import Optional, Set
 
 from apscheduler.job import Job
 from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.asyncio import run_in_event_loop
-from apscheduler.util import datetime_to_utc_timestamp
+from apscheduler.util import datetime_to_utc_timestamp, ref_to_obj, utc_timestamp_to_datetime
 from redbot.core import Config
 
 # TODO: use get_lock on config maybe
 from redbot.core.bot import Red
 from redbot.core.utils import AsyncIter
 
+from fifo.job_encoding import (
+    JOB_FORMAT_VERSION,
+    UnsupportedTrigger,
+    decode_trigger,
+    encode_trigger,
+)
+
 log = logging.getLogger("red.fox_v3.fifo.jobstore")
 log.setLevel(logging.DEBUG)
 
@@ -20,6 +28,19 @@ save_task_objects = []
 
 
 class RedConfigJobStore(MemoryJobStore):
+    """
+    MemoryJobStore that keeps Config up to date, one record per job in `jobs_by_id`
+
+    Every add, update (including each new `next_run_time` after a run) and remove
+    marks just that job as changed. Changes are written together `save_delay` seconds later,
+    so a burst of runs is one write per job instead of one per run.
+    """
+
+    save_delay = 1.0
+    # More changed jobs than this are saved with one write of every job instead of one write each,
+    # the JSON driver rewrites the whole file on every write anyway
+    bulk_save_threshold = 10
+
     def __init__(self, config: Config, bot: Red):
         super().__init__()
         self.config = config
@@ -27,6 +48,10 @@ class RedConfigJobStore(MemoryJobStore):
         self.pickle_protocol = pickle.HIGHEST_PROTOCOL
         self._eventloop = self.bot.loop  # Used for @run_in_event_loop
 
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
     @run_in_event_loop
     def start(self, scheduler, alias):
         super().start(scheduler, alias)
@@ -35,26 +60,131 @@ class RedConfigJobStore(MemoryJobStore):
             job._jobstore_alias = self._alias
 
     async def load_from_config(self):
-        _jobs = await self.config.jobs()
+        legacy_jobs = await self.config.jobs()
+        if legacy_jobs:
+            # Everything used to be saved as one list on shutdown, move it to one record per job
+            records = {job["_id"]: job for job, timestamp in legacy_jobs}
+        else:
+            records = await self.config.jobs_by_id()
+
         # self._jobs = [
         #     (await self._decode_job(job), timestamp) async for (job, timestamp) in AsyncIter(_jobs)
         # ]
-        async for job, timestamp in AsyncIter(_jobs, steps=5):
-            job = await self._decode_job(job)
-            index = self._get_job_index(timestamp, job.id)
-            self._jobs.insert(index, (job, timestamp))
+        pickled = []
+        async for record in AsyncIter(records.values(), steps=100):
+            job = self._decode_job(record)
+            timestamp = record["next_run_time"]
+            self._jobs.append((job, timestamp))
             self._jobs_index[job.id] = (job, timestamp)
+            if record.get("version", 1) == 1:
+                pickled.append(job.id)
+        # Same order `_get_job_index` keeps, sorted once instead of inserting one at a time
+        self._jobs.sort(key=lambda j: (j[1] if j[1] is not None else float("inf"), j[0].id))
+
+        if legacy_jobs or pickled:
+            # Rewrite pickled jobs in the current format (those that still can be), in one write
+            async with self._flush_lock:
+                await self._write_all()
+            await self.config.jobs.clear()
+            log.info(
+                f"Migrated {len(records)} jobs to per job records, "
+                f"{len(pickled)} were converted from pickles"
+            )
 
     async def save_to_config(self):
-        """Yea that's basically it"""
-        await self.config.jobs.set(
-            [(self._encode_job(job), timestamp) for job, timestamp in self._jobs]
-        )
+        """Rewrites every job, changes are normally saved as they happen. See `flush`"""
+        async with self._flush_lock:
+            await self._write_all()
+
+    async def _write_all(self):
+        dirty = self._dirty
+        self._dirty = set()
+        try:
+            await self.config.jobs_by_id.set(
+                {job.id: self._encode_job(job) for job, timestamp in self._jobs}
+            )
+        except asyncio.CancelledError:
+            self._dirty |= dirty  # Not written, leave them for the next flush
+            raise
+
+    def add_job(self, job: Job):
+        super().add_job(job)
+        self._job_changed(job.id)
+
+    def update_job(self, job: Job):
+        super().update_job(job)
+        self._job_changed(job.id)
+
+    def remove_job(self, job_id: str):
+        super().remove_job(job_id)
+        self._job_changed(job_id)
+
+    def _job_changed(self, job_id: str):
+        # The scheduler may call from another thread
+        self._eventloop.call_soon_threadsafe(self._mark_dirty, job_id)
+
+    def _mark_dirty(self, job_id: str):
+        self._dirty.add(job_id)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._dirty:  # Also catches jobs changed during a flush
+            await asyncio.sleep(self.save_delay)
+            await self.flush()
 
-        # self._jobs_index = await self.config.jobs_index.all()  # Overwritten by next
-        # self._jobs_index = {job.id: (job, timestamp) for job, timestamp in self._jobs}
+    async def flush(self):
+        """Writes only the jobs that changed since the last flush"""
+        async with self._flush_lock:
+            if len(self._dirty) > self.bulk_save_threshold:
+                await self._write_all()
+                return
+
+            pending = list(self._dirty)
+            self._dirty = set()
+            try:
+                while pending:
+                    job_id = pending[-1]
+                    job, timestamp = self._jobs_index.get(job_id, (None, None))
+                    if job is None:
+                        await self.config.jobs_by_id.clear_raw(job_id)
+                    else:
+                        await self.config.jobs_by_id.set_raw(job_id, value=self._encode_job(job))
+                    pending.pop()
+            except asyncio.CancelledError:
+                self._dirty.update(pending)  # Not written, leave them for the next flush
+                raise
 
     def _encode_job(self, job: Job):
+        """
+        Version 2 records are plain JSON: the trigger spec and which task to run
+
+        Jobs that can't be described that way are still pickled, see `_encode_job_pickle`
+        """
+        task_kwargs = {k: v for k, v in job.kwargs.items() if k not in ("config", "bot")}
+        if job.args or set(task_kwargs) != {"name", "guild_id"}:
+            return self._encode_job_pickle(job)
+        try:
+            trigger = encode_trigger(job.trigger)
+        except UnsupportedTrigger as e:
+            log.debug(f"Pickling {job.id}: {e}")
+            return self._encode_job_pickle(job)
+
+        return {
+            "_id": job.id,
+            "version": JOB_FORMAT_VERSION,
+            "next_run_time": datetime_to_utc_timestamp(job.next_run_time),
+            "func": job.func_ref,
+            "task": task_kwargs,
+            "trigger": trigger,
+            "name": job.name,
+            "executor": job.executor,
+            "misfire_grace_time": job.misfire_grace_time,
+            "coalesce": job.coalesce,
+            "max_instances": job.max_instances,
+        }
+
+    def _encode_job_pickle(self, job: Job):
         job_state = job.__getstate__()
         job_state["kwargs"]["config"] = None
         job_state["kwargs"]["bot"] = None
@@ -79,9 +209,30 @@ class RedConfigJobStore(MemoryJobStore):
 
         return out
 
-    async def _decode_job(self, in_job):
+    def _decode_job(self, in_job):
         if in_job is None:
             return None
+        if in_job.get("version", 1) == 1:
+            return self._decode_job_pickle(in_job)
+
+        job = Job.__new__(Job)
+        job.id = in_job["_id"]
+        job.func_ref = in_job["func"]
+        job.func = ref_to_obj(job.func_ref)
+        job.trigger = decode_trigger(in_job["trigger"])
+        job.executor = in_job["executor"]
+        job.args = ()
+        job.kwargs = {**in_job["task"], "config": self.config, "bot": self.bot}
+        job.name = in_job["name"]
+        job.misfire_grace_time = in_job["misfire_grace_time"]
+        job.coalesce = in_job["coalesce"]
+        job.max_instances = in_job["max_instances"]
+        job.next_run_time = utc_timestamp_to_datetime(in_job["next_run_time"])
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _decode_job_pickle(self, in_job):
         job_state = in_job["job_state"]
         job_state = pickle.loads(base64.b64decode(job_state))
         if job_state["args"]:  # Backwards compatibility on args to kwargs
@@ -112,10 +263,13 @@ class RedConfigJobStore(MemoryJobStore):
     @run_in_event_loop
     def remove_all_jobs(self):
         super().remove_all_jobs()
+        self._dirty.clear()
         asyncio.create_task(self._async_remove_all_jobs())
 
     async def _async_remove_all_jobs(self):
-        await self.config.jobs.clear()
+        async with self._flush_lock:
+            await self.config.jobs.clear()
+            await self.config.jobs_by_id.clear()
         # await self.config.jobs_index.clear()
 
     def shutdown(self):
@@ -123,6 +277,13 @@ class RedConfigJobStore(MemoryJobStore):
         asyncio.create_task(self.async_shutdown())
 
     async def async_shutdown(self):
-        await self.save_to_config()
+        if self._flush_task is not None:
+            # Only skips the delay, whatever it didn't write yet is still dirty
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
         self._jobs = []
         self._jobs_index = {}
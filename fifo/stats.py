@@ -0,0 +1,200 @@
+import json
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+
+from apscheduler.events import (
+    EVENT_JOB_ERROR,
+    EVENT_JOB_EXECUTED,
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+    EVENT_JOB_SUBMITTED,
+    JobEvent,
+)
+from apscheduler.schedulers.base import BaseScheduler
+
+log = logging.getLogger("red.fox_v3.fifo.stats")
+
+# Stop counting coalesced runs of a job after this many, it's been down a while
+MAX_COALESCED_COUNT = 1000
+
+
+class JobStats:
+    __slots__ = (
+        "lags",
+        "durations",
+        "succeeded",
+        "failed",
+        "errors",
+        "missed",
+        "coalesced",
+        "max_instances",
+        "running",
+        "peak_running",
+    )
+
+    def __init__(self, samples: int):
+        self.lags: Deque[float] = deque(maxlen=samples)  # Seconds from scheduled to submitted
+        self.durations: Deque[float] = deque(maxlen=samples)
+        self.succeeded = 0
+        self.failed = 0  # The task couldn't run, see `_execute_task`
+        self.errors = 0  # The task raised
+        self.missed = 0  # Later than misfire_grace_time
+        self.coalesced = 0  # Dropped because of coalesce
+        self.max_instances = 0  # Skipped because max_instances were already running
+        self.running = 0
+        self.peak_running = 0
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class SchedulerStats:
+    """
+    Per job fire lag, duration and outcome counts, from the scheduler's events
+
+    Only the last `samples` lags and durations of each job are kept.
+    Every event is also queued as a record for `drain`, when `keep_records` is set.
+    """
+
+    def __init__(self, samples=200, max_records=10000):
+        self.samples = samples
+        self.keep_records = False
+        self.scheduler: Optional[BaseScheduler] = None
+        self._jobs: Dict[str, JobStats] = {}
+        self._submitted: Dict[Tuple[str, datetime], float] = {}  # perf_counter at submission
+        self._next_run_times: Dict[str, Optional[datetime]] = {}
+        self._records: Deque[Dict] = deque(maxlen=max_records)
+
+    def attach(self, scheduler: BaseScheduler):
+        self.scheduler = scheduler
+        scheduler.add_listener(
+            self.listener,
+            EVENT_JOB_SUBMITTED
+            | EVENT_JOB_EXECUTED
+            | EVENT_JOB_ERROR
+            | EVENT_JOB_MISSED
+            | EVENT_JOB_MAX_INSTANCES,
+        )
+
+    def detach(self):
+        if self.scheduler is not None:
+            self.scheduler.remove_listener(self.listener)
+            self.scheduler = None
+
+    def clear(self):
+        self._jobs.clear()
+        self._records.clear()
+
+    def _get(self, job_id: str) -> JobStats:
+        stats = self._jobs.get(job_id)
+        if stats is None:
+            stats = self._jobs[job_id] = JobStats(self.samples)
+        return stats
+
+    def _count_coalesced(self, job_id: str, first_run_time: datetime) -> int:
+        """Runs between the last known next run time and `first_run_time` that never happened"""
+        previous = self._next_run_times.get(job_id)
+        job = self.scheduler.get_job(job_id) if self.scheduler is not None else None
+        self._next_run_times[job_id] = job.next_run_time if job is not None else None
+        if previous is None or job is None:
+            return 0
+
+        count = 0
+        run_time = previous
+        while run_time is not None and run_time < first_run_time and count < MAX_COALESCED_COUNT:
+            count += 1
+            run_time = job.trigger.get_next_fire_time(run_time, first_run_time)
+        return count
+
+    def listener(self, event: JobEvent):
+        try:
+            self._handle(event)
+        except Exception:  # Never let stats break the scheduler
+            log.exception(f"Failed to record {event}")
+
+    def _handle(self, event: JobEvent):
+        stats = self._get(event.job_id)
+        record = {"time": time.time(), "job": event.job_id}
+
+        if event.code == EVENT_JOB_SUBMITTED:
+            # Several run times only without coalesce, each gets its own executed event
+            run_times = event.scheduled_run_times
+            lag = (datetime.now(timezone.utc) - run_times[-1]).total_seconds()
+            stats.lags.append(lag)
+            stats.running += len(run_times)
+            stats.peak_running = max(stats.peak_running, stats.running)
+            coalesced = self._count_coalesced(event.job_id, run_times[0])
+            stats.coalesced += coalesced
+            for run_time in run_times:
+                self._submitted[(event.job_id, run_time)] = time.perf_counter()
+            record.update(event="submitted", lag=lag, coalesced=coalesced)
+
+        elif event.code in (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR):
+            stats.running = max(0, stats.running - 1)
+            started = self._submitted.pop((event.job_id, event.scheduled_run_time), None)
+            duration = None if started is None else time.perf_counter() - started
+            if duration is not None:
+                stats.durations.append(duration)
+            if event.code == EVENT_JOB_ERROR:
+                stats.errors += 1
+                outcome = "error"
+            elif event.retval is False:
+                stats.failed += 1
+                outcome = "failed"
+            else:
+                stats.succeeded += 1
+                outcome = "succeeded"
+            record.update(event=outcome, duration=duration)
+
+        elif event.code == EVENT_JOB_MISSED:
+            stats.missed += 1
+            stats.running = max(0, stats.running - 1)
+            self._submitted.pop((event.job_id, event.scheduled_run_time), None)
+            record.update(event="missed", scheduled=event.scheduled_run_time.timestamp())
+
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            stats.max_instances += 1
+            coalesced = self._count_coalesced(event.job_id, event.scheduled_run_times[0])
+            stats.coalesced += coalesced
+            record.update(event="max_instances", coalesced=coalesced)
+
+        if self.keep_records:
+            self._records.append(record)
+
+    def drain(self) -> List[Dict]:
+        """Records since the last drain, oldest first"""
+        records = list(self._records)
+        self._records.clear()
+        return records
+
+    def summary(self) -> str:
+        lines = [
+            f"{'job':<24}{'ok':>6}{'fail':>6}{'err':>5}{'miss':>6}{'coal':>6}{'maxi':>6}"
+            f"{'peak':>5}{'lag p50':>9}{'lag p95':>9}{'run p50':>9}{'run p95':>9}"
+        ]
+        for job_id in sorted(self._jobs):
+            stats = self._jobs[job_id]
+            lags = sorted(stats.lags)
+            durations = sorted(stats.durations)
+            times = "".join(
+                f"{_percentile(values, p):>9.2f}" if values else f"{'-':>9}"
+                for values in (lags, durations)
+                for p in (0.5, 0.95)
+            )
+            lines.append(
+                f"{job_id[:23]:<24}{stats.succeeded:>6}{stats.failed:>6}{stats.errors:>5}"
+                f"{stats.missed:>6}{stats.coalesced:>6}{stats.max_instances:>6}"
+                f"{stats.peak_running:>5}{times}"
+            )
+        return "\n".join(lines)
+
+
+def append_records(path, records: List[Dict]):
+    """Blocking, appends records to a JSON lines file"""
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
@@ -178,6 +178,32 @@ class FakeMessage(discord.Message):
         # self.__dict__.update(**d)
 
 
+def synthetic_message(channel: discord.TextChannel):
+    """
+    A message in `channel` built from a gateway payload, no API calls needed
+
+    Only used as the base of a `FakeMessage`, which fills in the author and content
+    """
+    payload = {
+        "id": time_snowflake(datetime.now(timezone.utc), high=False),
+        "channel_id": channel.id,
+        "guild_id": channel.guild.id,
+        "type": discord.MessageType.default.value,
+        "content": "",
+        "attachments": [],
+        "embeds": [],
+        "mentions": [],
+        "mention_roles": [],
+        "pinned": False,
+        "mention_everyone": False,
+        "tts": False,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "edited_timestamp": None,
+        "flags": 0,
+    }
+    return discord.Message(state=channel._state, channel=channel, data=payload)
+
+
 def neuter_message(message: FakeMessage):
     message.delete = _do_nothing
     message.edit = _do_nothing
@@ -411,6 +437,11 @@ class Task:
             return False
 
         actual_message: Optional[discord.Message] = channel.last_message
+        if actual_message is None:
+            try:
+                actual_message = synthetic_message(channel)
+            except Exception:  # Payload format changed in this discord.py version
+                log.exception(f"Could not build a message for Task[{self.name}], fetching one")
         # I'd like to present you my chain of increasingly desperate message fetching attempts
         if actual_message is None:
             # log.warning("No message found in channel cache yet, skipping execution")